@@ -60,8 +60,12 @@
                    "/home/admin/python-paxos-jepsen/paxos/requirements.txt")
            (info "starting daemon")
            (c/su
-            (c/exec "/bin/bash" "/home/admin/python-paxos-jepsen/start-daemon.sh"))
-           (Thread/sleep 10000))
+            (c/exec "/bin/bash" "/home/admin/python-paxos-jepsen/start-daemon.sh" node))
+           (info "awaiting readiness")
+           (c/exec "/bin/bash" "-c"
+                   (str "for i in $(seq 300); do "
+                        "curl -sf http://localhost:5000/ready && exit 0; sleep 0.1; "
+                        "done; exit 1")))
 
    (teardown! [_ test node]
               (info node "tearing down Paxos")
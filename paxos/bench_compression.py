@@ -0,0 +1,93 @@
+import argparse
+import dataclasses
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from message import *
+from network import ENCODINGS
+
+"""
+Benchmark compressing Promise and Accepted messages, see network.compress().
+
+For each history length, builds messages like an Acceptor's after that many
+slots, and prints their size and the time to serialize, compress and decompress
+them with each coding.
+"""
+
+_NODES = ["ip-10-0-1-17.ec2.internal:5000",
+          "ip-10-0-2-42.ec2.internal:5000",
+          "ip-10-0-3-99.ec2.internal:5000"]
+
+
+def _messages(n_slots: int) -> dict[str, Message]:
+    """A Promise and an Accepted with n_slots votes, from a few ballots."""
+    votes = VoteStore()
+    for slot in range(1, n_slots + 1):
+        # A new leader every 100 slots.
+        ballot = Ballot(1000.0 + slot // 100, _NODES[slot // 100 % 3])
+        votes.vote(ballot, [SlotValue(slot, Value(
+            client_id=4_000_000_000_000 + slot % 5,
+            command_id=slot,
+            payload=slot % 1000))])
+
+    ballot = Ballot(2000.0, _NODES[0])
+    return {
+        "Promise": Promise(_NODES[1], ballot, votes.to_voted_set()),
+        "Accepted": Accepted(_NODES[1], ballot, [
+            SlotValue(slot, Value(4_000_000_000_000, slot, slot % 1000))
+            for slot in range(1, n_slots + 1)]),
+    }
+
+
+def _timeit(fn, repeat: int) -> float:
+    """Min seconds per call."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main(lengths: list[int], repeat: int) -> None:
+    print(f"{'message':>8} {'slots':>6} {'coding':>8} {'bytes':>10}"
+          f" {'ratio':>6} {'json us':>9} {'compress us':>12}"
+          f" {'decompress us':>14}")
+    for n_slots in lengths:
+        for name, message in _messages(n_slots).items():
+            def serialize():
+                return json.dumps(dataclasses.asdict(message),
+                                  separators=(",", ":")).encode()
+
+            body = serialize()
+            json_us = _timeit(serialize, repeat) * 1e6
+            print(f"{name:>8} {n_slots:>6} {'identity':>8} {len(body):>10}"
+                  f" {1:>6.1f} {json_us:>9.0f} {0:>12.0f} {0:>14.0f}")
+            for encoding, (compress, decompress) in ENCODINGS.items():
+                compressed = compress(body)
+                compress_us = _timeit(lambda: compress(body), repeat) * 1e6
+                decompress_us = _timeit(
+                    lambda: decompress(compressed, len(body)), repeat) * 1e6
+                print(f"{name:>8} {n_slots:>6} {encoding:>8}"
+                      f" {len(compressed):>10}"
+                      f" {len(body) / len(compressed):>6.1f}"
+                      f" {json_us:>9.0f}"
+                      f" {compress_us:>12.0f}"
+                      f" {decompress_us:>14.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Compression benchmark")
+    parser.add_argument(
+        "--lengths", type=int, nargs="+", default=[10, 100, 1000, 10_000],
+        help="History lengths, in slots")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="Time the best of this many runs")
+    args = parser.parse_args()
+    main(args.lengths, args.repeat)
@@ -1,11 +1,15 @@
 import argparse
 import dataclasses
+import json
 import os
+import random
 import sys
 import typing
 import logging
+from typing import Optional
+from urllib.parse import quote
 
-from message import ClientReply
+from message import ClientReply, KVReply
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
@@ -15,26 +19,54 @@ from network import send
 logging.basicConfig()
 
 
-def main(raw_config: typing.IO, port: int, server: int, payload: int):
+def main(raw_config: typing.IO,
+         port: int,
+         server: int,
+         payload: typing.Union[int, str],
+         key: Optional[str],
+         retries: int):
     config = Config.from_file(raw_config, default_port=port)
-    node = config.nodes[server]
-    # pid is unique enough, all clients can use command_id 1.
-    r = ClientRequest(client_id=os.getpid(),
+    # Servers remember each client's latest command, so a reused pid could
+    # look like a retry. A random id is unique enough, and all clients can use
+    # command_id 1.
+    r = ClientRequest(client_id=random.getrandbits(53),
                       command_id=1,
                       payload=payload)
 
-    raw_reply = send(
-        node=node,
-        url='/proposer/client-request',
-        raw_message=dataclasses.asdict(r),
-        timeout=20)
+    url = '/proposer/client-request'
+    if key is not None:
+        # The server routes by key if it runs multiple Paxos groups.
+        url += f'?key={quote(key)}'
 
-    if raw_reply is None:
+    for attempt in range(retries + 1):
+        # Retry on the next server. Same ids, so it won't be applied twice.
+        node = config.nodes[(server + attempt) % len(config.nodes)]
+        raw_reply = send(
+            node=node,
+            url=url,
+            raw_message=dataclasses.asdict(r),
+            timeout=20)
+
+        if raw_reply is not None:
+            break
+    else:
         sys.exit(1)
 
-    reply = ClientReply.from_dict(raw_reply)
-    # Like "[1, 2, 3]".
-    print(reply.state)
+    if "state" in raw_reply:
+        reply = ClientReply.from_dict(raw_reply)
+        # Like "[1, 2, 3]".
+        print(reply.state)
+    else:
+        # Like '{"ok": true, "value": "x"}', see server.py --state-machine.
+        print(json.dumps(dataclasses.asdict(KVReply.from_dict(raw_reply))))
+
+
+def payload_arg(arg: str) -> typing.Union[int, str]:
+    """An int to append, or a key-value command like "put x 1"."""
+    try:
+        return int(arg)
+    except ValueError:
+        return arg
 
 
 if __name__ == '__main__':
@@ -48,6 +80,20 @@ if __name__ == '__main__':
         "--server", type=int, default=0,
         help="Server number (0 through number of nodes in config)")
     parser.add_argument(
-        "payload", type=int)
+        "--key", default=None,
+        help="Key that chooses the Paxos group (see server.py --groups)."
+             " Key-value commands use their own key")
+    parser.add_argument(
+        "--retries", type=int, default=0,
+        help="Retry this many times on the next servers")
+    parser.add_argument(
+        "payload", type=payload_arg,
+        help='An int, or with server.py --state-machine kv, a command like'
+             ' "get KEY", "put KEY VALUE" or "cas KEY OLD NEW"')
     args = parser.parse_args()
-    main(args.config, args.port, args.server, args.payload)
+    main(args.config,
+         args.port,
+         args.server,
+         args.payload,
+         args.key,
+         args.retries)
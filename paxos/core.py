@@ -1,23 +1,31 @@
 import math
+import contextlib
 import dataclasses
 import logging
 import queue
+import random
 import time
 import typing
-from collections import defaultdict, deque
-from concurrent.futures import Future, ThreadPoolExecutor
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 from typing import Optional, Sequence
 
 from dataclasses import dataclass
 
+import tracing
 from message import *
 from network import send, send_to_all
+from statemachine import AppendList, StateMachine
 
 __all__ = [
     "Config",
     "Agent",
     "Proposer",
     "Acceptor",
+    "GROUP_PORT_STRIDE",
+    "group_node",
+    "group_for_key",
 ]
 
 _logger = logging.getLogger("paxos")
@@ -53,6 +61,40 @@ class Config:
         """Get my entry in 'nodes'. Blocks waiting for set_self()."""
         return self._found_self.result()
 
+    def slot_owner(self, slot: Slot) -> str:
+        """The node that proposes for 'slot' with rotating slot ownership."""
+        return self.nodes[(slot - 1) % len(self.nodes)]
+
+    def for_group(self, group: int) -> "Config":
+        """Config for one Paxos group, see server.py --groups.
+
+        Doesn't block, but the new Config's get_self() blocks until this one's
+        set_self() is called.
+        """
+        config = Config([group_node(n, group) for n in self.nodes])
+        self._found_self.add_done_callback(
+            lambda f: config.set_self(group_node(f.result(), group)))
+        return config
+
+
+# With multiple Paxos groups per server, group N listens on the server's port
+# plus GROUP_PORT_STRIDE * (N + 1).
+GROUP_PORT_STRIDE = 100
+
+
+def group_node(node: str, group: int) -> str:
+    """Map a server's "host:port" to the "host:port" of one of its groups."""
+    host, port = node.rsplit(":", 1)
+    return f"{host}:{int(port) + GROUP_PORT_STRIDE * (group + 1)}"
+
+
+def group_for_key(key: str, n_groups: int) -> int:
+    """Choose the Paxos group that owns a key.
+
+    Use crc32, not hash(), so all processes agree.
+    """
+    return zlib.crc32(key.encode()) % n_groups
+
 
 class Agent:
     """An agent (or "process") fulfilling a role in the Paxos protocol."""
@@ -77,26 +119,69 @@ class Agent:
 
         future.add_done_callback(done_callback)
 
-    def receive(self, message: Message) -> Message:
-        """Handle a request, return the reply."""
+    def receive(self,
+                message: Message,
+                timeout: Optional[float] = None) -> Message:
+        """Handle a request, return the reply.
+
+        Raises concurrent.futures.TimeoutError after timeout seconds, if not
+        None. The agent drops the message if it hasn't started on it by then.
+        """
         _logger.info("%s got %s", self.__class__.__name__, message)
-        future = Future()
-        self.__q.put(Agent._QEntry(message, future))
-        return future.result()
+        with tracing.span(f"{self.__class__.__name__}.receive"):
+            future = Future()
+            deadline = (math.inf if timeout is None
+                        else time.monotonic() + timeout)
+            self.__q.put(Agent._QEntry(
+                message, future, deadline, tracing.get_trace_id()))
+            return future.result(timeout=timeout)
 
     @dataclass
     class _QEntry:
         message: Message
         reply_future: Future[Message]
+        # time.monotonic() when the sender gives up.
+        deadline: float = math.inf
+        trace_id: Optional[str] = None
+        # time.perf_counter() when queued, for tracing.
+        queued: Optional[float] = dataclasses.field(
+            default_factory=time.perf_counter)
+
+        @contextlib.contextmanager
+        def tracing(self):
+            """Trace the handling of this entry, and time spent queued."""
+            with tracing.trace_id(self.trace_id):
+                if self.queued is not None:
+                    tracing.record("queued", self.queued, time.perf_counter())
+                    self.queued = None
+
+                yield
 
     def _main_loop(self, q: queue.Queue["Agent._QEntry"]) -> None:
         raise NotImplementedError()
 
+    @staticmethod
+    def _get_batch(q: queue.Queue["Agent._QEntry"],
+                   timeout: Optional[float] = None) -> list["Agent._QEntry"]:
+        """Await one entry, then take all others already queued.
+
+        Raises queue.Empty on timeout.
+        """
+        batch = [q.get(timeout=timeout)]
+        while True:
+            try:
+                batch.append(q.get_nowait())
+            except queue.Empty:
+                return batch
+
     def _send(self, node: str, url: str, message: Message) -> None:
         """Send message without awaiting reply."""
         _logger.info("Send %s to %s%s", message, node, url)
-        self.__executor.submit(
-            send, node=node, url=url, raw_message=dataclasses.asdict(message))
+        self.__executor.submit(send,
+                               node=node,
+                               url=url,
+                               raw_message=dataclasses.asdict(message),
+                               trace_id=tracing.get_trace_id())
 
     def _send_to_all(self, url: str, message: Message) -> None:
         """Send message to all nodes without awaiting reply."""
@@ -104,7 +189,30 @@ class Agent:
         self.__executor.submit(send_to_all,
                                nodes=self._config.nodes,
                                url=url,
-                               raw_message=dataclasses.asdict(message))
+                               raw_message=dataclasses.asdict(message),
+                               trace_id=tracing.get_trace_id())
+
+
+@dataclass
+class _Session:
+    """The latest command applied for a client, see Proposer._sessions."""
+    command_id: int
+    # The command's result, see StateMachine.reply().
+    result: typing.Any
+    # The slot where it was applied.
+    slot: Slot
+
+
+def _chain(source: Future, destination: Future) -> None:
+    """Resolve destination like source, once source is done."""
+
+    def callback(f: Future):
+        if f.exception() is not None:
+            destination.set_exception(f.exception())
+        else:
+            destination.set_result(f.result())
+
+    source.add_done_callback(callback)
 
 
 class Proposer(Agent):
@@ -113,27 +221,68 @@ class Proposer(Agent):
     def __init__(self,
                  config: Config,
                  propose_url: str,
-                 accept_url: str):
+                 accept_url: str,
+                 catch_up_url: str,
+                 catch_up_reply_url: str,
+                 catch_up_batch_size: int = 1000,
+                 catch_up_interval: float = 1,
+                 rotating: bool = False,
+                 accept_resend_interval: float = 1,
+                 session_expiry_slots: int = 10000,
+                 state_machine: Optional[StateMachine] = None):
         super().__init__(config)
+        # Mencius-style: each node proposes only in the slots it owns, see
+        # Config.slot_owner(), and skips Phase 1. There's no revocation, if a
+        # node is down its slots stay empty and block later slots.
+        self._rotating = rotating
+        # My next slot to propose in, with rotating ownership.
+        self._next_own_slot: Optional[Slot] = None
+        # Accepts for my own slots, awaiting a majority of Accepted messages,
+        # and when I last sent each.
+        self._own_accepts: dict[Ballot, tuple[Accept, float]] = {}
+        # Seconds until I resend an Accept for my own slots. No one else can
+        # fill them, a lost Accept would block the log.
+        self._accept_resend_interval = accept_resend_interval
         self._propose_url = propose_url
         self._accept_url = accept_url
+        self._catch_up_url = catch_up_url
+        self._catch_up_reply_url = catch_up_reply_url
+        # Max decisions per CatchUpReply.
+        self._catch_up_batch_size = catch_up_batch_size
+        # Min seconds between CatchUpRequests, while we have a gap.
+        self._catch_up_interval = catch_up_interval
+        self._last_catch_up = -math.inf
         self._max_ts = -1
         # "pBal" in Chand. Don't init until we can call get_self() w/o deadlock.
         self._ballot: Optional[Ballot] = None
         # ClientRequests we haven't used in Accept messages.
         self._requests_unserviced: deque[ClientRequest] = deque()
+        # When clients give up on their requests, see Agent.receive().
+        self._deadlines: dict[Value, float] = {}
         # "Promise" messages received from Acceptors.
         self._promises: dict[Ballot, list[Promise]] = defaultdict(list)
         # Values we've proposed, which are awaiting Accepted messages.
         self._proposals: dict[Slot, Value] = {}
-        # "Accepted" messages received from Acceptors.
-        self._accepteds: dict[Ballot, list[Accepted]] = defaultdict(list)
+        # "Accepted" messages received from Acceptors, the latest from each.
+        # An Acceptor can send several for one ballot, e.g. if I resend an
+        # Accept for my own slots, so count Acceptors, not messages.
+        self._accepteds: dict[Ballot, dict[str, Accepted]] = defaultdict(dict)
         # Map slot to value (None is undecided), and whether it's been applied.
         self._decisions: dict[Slot, tuple[Optional[Value], bool]] = {}
+        # Slots up to this one are decided and applied. Slots start at 1.
+        # Those before a restore() aren't in _decisions.
+        self._applied_through: Slot = 0
+        self._max_decided: Slot = 0
         # Clients waiting for a response.
         self._futures: dict[Value, Future[Message]] = {}
-        # The replicated state machine (RSM) is just an appendable list of ints.
-        self._state: list[int] = []
+        # The replicated state machine (RSM), see statemachine.py.
+        self._state_machine = state_machine or AppendList()
+        # Map client_id to its latest applied command, oldest first, so we
+        # apply each command once and answer retries. Every server applies the
+        # same log, so all have the same sessions.
+        self._sessions: OrderedDict[int, _Session] = OrderedDict()
+        # Forget a client after this many slots with no commands from it.
+        self._session_expiry_slots = session_expiry_slots
 
     def _record_ts(self, ts: float):
         self._max_ts = max(self._max_ts, ts)
@@ -157,18 +306,114 @@ class Proposer(Agent):
 
         return self._ballot
 
+    @tracing.traced
     def _handle_client_request(self,
                                client_request: ClientRequest,
-                               future: Future[Message]) -> None:
-        # Phase 1a, Fig. 2 of Chand.
+                               future: Future[Message],
+                               deadline: float = math.inf) -> bool:
+        """Return True if the request needs proposing."""
+        value = client_request.get_value()
+        if deadline < time.monotonic():
+            _logger.info("Drop %s, client gave up while it was queued", value)
+            future.set_exception(TimeoutError(f"{value} expired in queue"))
+            return False
+
+        session = self._sessions.get(value.client_id)
+        if session is not None and value.command_id <= session.command_id:
+            _logger.info("Already applied %s, reply from session", value)
+            self._reply(value, session, future)
+            return False
+
+        try:
+            self._state_machine.check(value.payload)
+        except ValueError as exc:
+            future.set_exception(exc)
+            return False
+
+        if value in self._futures:
+            _logger.info("Already proposing %s, await it", value)
+            _chain(self._futures[value], future)
+            # Don't drop it while the retry's client is still waiting.
+            self._deadlines[value] = max(self._deadlines[value], deadline)
+            return False
+
+        # Phase 1a, Fig. 2 of Chand. See _service_requests().
         self._requests_unserviced.appendleft(client_request)
-        self._futures[client_request.get_value()] = future
-        self._send_prepare()
+        self._futures[value] = future
+        self._deadlines[value] = deadline
+        return True
+
+    def _drop_expired_requests(self) -> None:
+        """Don't propose requests whose clients have given up."""
+        now = time.monotonic()
+        for cr in list(self._requests_unserviced):
+            value = cr.get_value()
+            if self._deadlines[value] < now:
+                _logger.info("Drop %s, client gave up before we proposed it",
+                             value)
+                self._requests_unserviced.remove(cr)
+                self._deadlines.pop(value)
+                self._futures.pop(value).set_exception(
+                    TimeoutError(f"{value} expired before proposal"))
+
+    def _service_requests(self):
+        """Start proposing unserviced requests, once per batch of messages."""
+        self._drop_expired_requests()
+        if self._rotating:
+            values = []
+            while self._requests_unserviced:
+                values.append(self._requests_unserviced.pop().get_value())
+
+            self._propose_own_slots(values)
+        elif self._requests_unserviced:
+            self._send_prepare()
 
     def _send_prepare(self):
         prepare = Prepare(self.get_uri(), self._get_ballot(should_inc=True))
         self._send_to_all(self._propose_url, prepare)
 
+    def _get_next_own_slot(self) -> Slot:
+        # Don't init until we can call get_self() w/o deadlock.
+        if self._next_own_slot is None:
+            self._next_own_slot = self._config.nodes.index(self.get_uri()) + 1
+
+        return self._next_own_slot
+
+    def _propose_own_slots(self, values: list[Value]) -> None:
+        """Phase 2a in my own slots, no Phase 1 needed.
+
+        Only the owner proposes in a slot, so there's nothing to conflict with.
+        """
+        svs = []
+        for value in values:
+            # If I restarted, I may have learned decisions in my old slots.
+            while (slot := self._get_next_own_slot()) in self._decisions:
+                self._next_own_slot += len(self._config.nodes)
+
+            assert self._config.slot_owner(slot) == self.get_uri()
+            self._next_own_slot += len(self._config.nodes)
+            self._proposals[slot] = value
+            svs.append(SlotValue(slot, value))
+            _logger.info("Proposing %s for own slot %s", value, slot)
+
+        if not svs:
+            return
+
+        # A fresh ballot per Accept, so Learners count Accepteds per Accept.
+        accept = Accept(self.get_uri(),
+                        Ballot(self._next_ts(), self.get_uri()),
+                        svs)
+        self._own_accepts[accept.ballot] = (accept, time.monotonic())
+        self._send_to_all(self._accept_url, accept)
+
+    def _skip_own_slots(self, slot: Slot) -> None:
+        """Fill my unused slots before 'slot' with no-ops."""
+        n_skipped = math.ceil(
+            (slot - self._get_next_own_slot()) / len(self._config.nodes))
+        if n_skipped > 0:
+            self._propose_own_slots([Value.noop()] * n_skipped)
+
+    @tracing.traced
     def _handle_promise(self,
                         promise: Promise,
                         future: Future[Message]) -> None:
@@ -186,6 +431,7 @@ class Proposer(Agent):
         slot_values = max_sv([p.voted for p in promises])
         # Choose new slots for the client's values.
         new_slot = max((sv.slot for sv in slot_values), default=0) + 1
+        self._drop_expired_requests()
         while self._requests_unserviced:
             cr = self._requests_unserviced.pop()
             slot_values.add(SlotValue(new_slot, cr.get_value()))
@@ -197,12 +443,17 @@ class Proposer(Agent):
         accept = Accept(self.get_uri(), promise.ballot, list(slot_values))
         self._send_to_all(self._accept_url, accept)
 
+    @tracing.traced
     def _handle_accepted(self,
                          accepted: Accepted,
                          future: Future[Message]) -> None:
         # This is a Learner procedure, and Chand doesn't cover Learners.
         future.set_result(OK())
-        self._accepteds[accepted.ballot].append(accepted)
+        if self._rotating and accepted.voted:
+            # Others are using later slots, don't make them wait for mine.
+            self._skip_own_slots(max(sv.slot for sv in accepted.voted))
+
+        self._accepteds[accepted.ballot][accepted.from_uri] = accepted
         self._record_ts(accepted.ballot.ts)
         accepteds = self._accepteds[accepted.ballot]
         if len(accepteds) <= len(self._config.nodes) // 2:
@@ -210,95 +461,305 @@ class Proposer(Agent):
             return
 
         self._accepteds.pop(accepted.ballot)
+        self._own_accepts.pop(accepted.ballot, None)
         # TODO: assert no conflicts among accepteds.
         for sv in accepted.voted:
-            if sv.slot not in self._decisions:
-                # TODO: do we need Applied for correctness?
-                self._decisions[sv.slot] = (sv.value, False)  # Applied=False.
-
-        # Update the RSM with newly unblocked decisions.
-        # TODO: don't think this is right. Some proposals for lower slots could
-        # still be undecided. Should propose None for those and await decision?
-        _logger.info(
-            'Decisions (slot, value, applied): %s',
-            [(slot, value.payload, applied)
-             for slot, (value, applied) in sorted(self._decisions.items())])
-
-        for slot, (value, applied) in sorted(self._decisions.items()):
-            if proposal := self._proposals.pop(slot, None):
-                if proposal != value:
-                    # Failed proposal.
-                    _logger.info("Re-enqueue %s", proposal)
-                    # TODO: just make Value and ClientRequest the same.
-                    cr = ClientRequest(**dataclasses.asdict(proposal))
-                    assert cr not in self._requests_unserviced
-                    assert proposal in self._futures
-                    self._requests_unserviced.appendleft(cr)
-
-            if value is None:
-                # Still undecided, can't execute any later slots.
-                break
+            self._decide(sv.slot, sv.value)
 
-            if applied:
-                continue
+    def _decide(self, slot: Slot, value: Value) -> None:
+        """Record a decided value, re-enqueue our proposal if it lost."""
+        if slot <= self._applied_through or slot in self._decisions:
+            return
 
-            self._apply(value)
+        # TODO: do we need Applied for correctness?
+        self._decisions[slot] = (value, False)  # Applied=False.
+        self._max_decided = max(self._max_decided, slot)
+        if proposal := self._proposals.pop(slot, None):
+            if proposal != value:
+                # Failed proposal.
+                if proposal not in self._futures:
+                    # A no-op, or applied in another slot, see _sessions.
+                    return
+
+                _logger.info("Re-enqueue %s", proposal)
+                if self._rotating:
+                    # I restarted and reused a slot, try my next one.
+                    self._propose_own_slots([proposal])
+                    return
+
+                # TODO: just make Value and ClientRequest the same.
+                cr = ClientRequest(**dataclasses.asdict(proposal))
+                assert cr not in self._requests_unserviced
+                self._requests_unserviced.appendleft(cr)
+
+    @tracing.traced
+    def _apply_decisions(self) -> None:
+        """Update the RSM with newly unblocked decisions, in one batch.
+
+        Stops at the first undecided slot, we can't execute any later slots
+        until we learn it, see _maybe_catch_up().
+        """
+        # Values to execute, their new sessions, and all values with sessions.
+        values: list[Value] = []
+        sessions: list[_Session] = []
+        done: list[tuple[Value, _Session]] = []
+        while (slot := self._applied_through + 1) in self._decisions:
+            value, applied = self._decisions[slot]
+            assert not applied
             self._decisions[slot] = (value, True)  # Applied=True.
+            self._applied_through = slot
+            if value.is_noop():
+                continue
 
-    def _min_undecided_slot(self):
+            session = self._sessions.get(value.client_id)
+            if session is not None and value.command_id <= session.command_id:
+                # E.g., the client retried on another server, both proposed.
+                _logger.info("Skip duplicate %s in slot %s", value, slot)
+            else:
+                # Result is set below, once the batch is executed.
+                session = _Session(value.command_id, None, slot)
+                self._sessions[value.client_id] = session
+                self._sessions.move_to_end(value.client_id)
+                # Per slot, so all servers agree, however they batch.
+                self._expire_sessions(slot)
+                values.append(value)
+                sessions.append(session)
+
+            done.append((value, session))
+
+        if values:
+            results = self._state_machine.apply_batch(values)
+            for session, result in zip(sessions, results):
+                session.result = result
+
+        for value, session in done:
+            if value in self._futures:
+                self._reply_applied(value, session)
+
+    def _min_undecided_slot(self) -> Slot:
         """First slot without a majority-accepted value."""
-        return min(
-            (s for s, v in self._decisions.items() if v is None),
-            default=len(self._decisions))
+        return self._applied_through + 1
 
-    def _apply(self, value: Value):
-        """Actually update the RSM and reply to the client."""
-        self._state.append(value.payload)
-        if value in self._futures:
-            # This server is the one responsible for replying to the client.
-            self._futures.pop(value).set_result(ClientReply(self._state))
+    def _has_gap(self) -> bool:
+        """True if some slot is decided but an earlier one isn't."""
+        return self._max_decided > self._applied_through
+
+    def _maybe_catch_up(self) -> None:
+        """If we missed decisions, ask a peer for them (rate-limited)."""
+        if not self._has_gap():
+            return
+
+        now = time.monotonic()
+        if now - self._last_catch_up < self._catch_up_interval:
+            return
+
+        self._last_catch_up = now
+        peers = [n for n in self._config.nodes if n != self.get_uri()]
+        if not peers:
+            return
+
+        # Ask a different random peer each time, in case one is also behind.
+        peer = random.choice(peers)
+        first_slot = self._min_undecided_slot()
+        _logger.info("Gap at slot %s, catch up from %s", first_slot, peer)
+        self._send(peer,
+                   self._catch_up_url,
+                   CatchUpRequest(self.get_uri(), first_slot))
+
+    @tracing.traced
+    def _handle_catch_up_request(self,
+                                 catch_up_request: CatchUpRequest,
+                                 future: Future[Message]) -> None:
+        # Reply by streaming decisions in batches, not in the HTTP response.
+        future.set_result(OK())
+        decided = [SlotValue(slot, value)
+                   for slot, (value, _) in sorted(self._decisions.items())
+                   if slot >= catch_up_request.first_slot]
+
+        for i in range(0, len(decided), self._catch_up_batch_size):
+            self._send(catch_up_request.from_uri,
+                       self._catch_up_reply_url,
+                       CatchUpReply(self.get_uri(),
+                                    decided[i:i + self._catch_up_batch_size]))
+
+    @tracing.traced
+    def _handle_catch_up_reply(self,
+                               catch_up_reply: CatchUpReply,
+                               future: Future[Message]) -> None:
+        future.set_result(OK())
+        for sv in catch_up_reply.decided:
+            self._decide(sv.slot, sv.value)
+
+    def _reply_applied(self, value: Value, session: _Session) -> None:
+        """This server is the one responsible for replying to the client."""
+        self._reply(value, session, self._futures.pop(value))
+        self._deadlines.pop(value, None)
+        # Another server proposed it before we did, so don't.
+        cr = ClientRequest(**dataclasses.asdict(value))
+        if cr in self._requests_unserviced:
+            self._requests_unserviced.remove(cr)
+
+    def _reply(self, value: Value, session: _Session, future: Future[Message]):
+        """Reply to an applied command."""
+        if value.command_id == session.command_id:
+            future.set_result(self._state_machine.reply(session.result))
+        else:
+            # Client already sent a later command, it's given up on this one.
+            future.set_exception(ValueError(
+                f"Stale {value}, latest command is {session.command_id}"))
+
+    def snapshot(self) -> dict:
+        """The RSM's state as a JSON-ish object, with what restore() needs to
+        keep applying each command once: the sessions and the last slot.
+
+        Call from the main loop's thread, or before run().
+        """
+        return {
+            "applied_through": self._applied_through,
+            "state": self._state_machine.snapshot(),
+            # Oldest first, like _sessions.
+            "sessions": [[client_id, s.command_id, s.result, s.slot]
+                         for client_id, s in self._sessions.items()],
+        }
+
+    def restore(self, snapshot: dict) -> None:
+        """Replace the RSM and sessions with any server's snapshot().
+
+        Forgets decisions the snapshot covers, so I can't send them in
+        CatchUpReplies. Since no server truncates its log yet, catch-up doesn't
+        need snapshots. Call from the main loop's thread, or before run().
+        """
+        self._state_machine.restore(snapshot["state"])
+        self._sessions = OrderedDict(
+            (client_id, _Session(command_id, result, slot))
+            for client_id, command_id, result, slot in snapshot["sessions"])
+        self._applied_through = snapshot["applied_through"]
+        self._max_decided = max(self._max_decided, self._applied_through)
+        for slot in [s for s in self._decisions if s <= self._applied_through]:
+            del self._decisions[slot]
+
+    def _expire_sessions(self, slot: Slot) -> None:
+        """Forget inactive clients. Depends only on the log, like the RSM."""
+        while self._sessions:
+            client_id, session = next(iter(self._sessions.items()))
+            if session.slot > slot - self._session_expiry_slots:
+                break
+
+            self._sessions.popitem(last=False)
 
     def _main_loop(self, q: queue.Queue[Agent._QEntry]) -> None:
         while True:
             try:
-                entry = q.get(timeout=1)
+                batch = self._get_batch(q, timeout=1)
             except queue.Empty:
                 # Any failed Prepare attempts?
+                self._drop_expired_requests()
                 if self._requests_unserviced:
                     _logger.info("%s unserviced requests, send Prepare again",
                                  len(self._requests_unserviced))
                     self._send_prepare()
 
+                self._resend_own_accepts()
+                # Any missed decisions?
+                self._maybe_catch_up()
                 continue
 
-            if isinstance(entry.message, ClientRequest):
-                self._handle_client_request(entry.message, entry.reply_future)
-            elif isinstance(entry.message, Promise):
-                self._handle_promise(entry.message, entry.reply_future)
-            elif isinstance(entry.message, Accepted):
-                self._handle_accepted(entry.message, entry.reply_future)
-            else:
-                entry.reply_future.set_exception(
-                    ValueError(f"Unexpected {entry.message}"))
+            with tracing.profiled():
+                self._handle_batch(batch)
+
+    def _handle_batch(self, batch: list[Agent._QEntry]) -> None:
+        """Handle all queued messages, then send Prepares and apply decisions.
+
+        One Prepare (or, with rotating slots, one Accept) for all ClientRequests
+        in the batch, instead of one per request.
+        """
+        n_decisions = len(self._decisions)
+        has_client_request = False
+        # Trace the Prepare or Accept with the first request it's for.
+        request_trace_id: Optional[str] = None
+        for entry in batch:
+            with entry.tracing():
+                if isinstance(entry.message, ClientRequest):
+                    if self._handle_client_request(entry.message,
+                                                   entry.reply_future,
+                                                   entry.deadline):
+                        if not has_client_request:
+                            request_trace_id = entry.trace_id
+
+                        has_client_request = True
+                elif isinstance(entry.message, Promise):
+                    self._handle_promise(entry.message, entry.reply_future)
+                elif isinstance(entry.message, Accepted):
+                    self._handle_accepted(entry.message, entry.reply_future)
+                elif isinstance(entry.message, CatchUpRequest):
+                    self._handle_catch_up_request(entry.message,
+                                                  entry.reply_future)
+                elif isinstance(entry.message, CatchUpReply):
+                    self._handle_catch_up_reply(entry.message,
+                                                entry.reply_future)
+                else:
+                    entry.reply_future.set_exception(
+                        ValueError(f"Unexpected {entry.message}"))
+
+        if has_client_request:
+            with tracing.trace_id(request_trace_id):
+                self._service_requests()
+
+        if len(self._decisions) > n_decisions:
+            _logger.info(
+                'Decisions (slot, value, applied): %s',
+                [(slot, value.payload, applied)
+                 for slot, (value, applied) in sorted(self._decisions.items())])
+
+            self._apply_decisions()
+            self._maybe_catch_up()
+
+        # Under load too, not only when idle.
+        self._resend_own_accepts()
+
+    def _resend_own_accepts(self) -> None:
+        """Resend Accepts for my own slots that didn't reach a majority."""
+        now = time.monotonic()
+        for ballot, (accept, sent) in list(self._own_accepts.items()):
+            if all(sv.slot in self._decisions for sv in accept.voted):
+                self._own_accepts.pop(ballot)
+                continue
+
+            if now - sent < self._accept_resend_interval:
+                continue
+
+            _logger.info("Resend %s", accept)
+            self._own_accepts[ballot] = (accept, now)
+            self._send_to_all(self._accept_url, accept)
 
 
 # Fig. 4 of Chand, auxiliary operators.
-def max_sv(vs: Sequence[VotedSet]) -> set[SlotValue]:
+@tracing.traced
+def max_sv(vs: Sequence[typing.Union[VotedSet, VoteStore]]) -> set[SlotValue]:
     """(slot, val) with highest-ballot-numbered value for each slot.
 
     Incoming vs is a list of dicts, which map slot to highest-balloted PValue,
     which is (ballot, slot, value). For each slot, choose highest-balloted
-    PValue among all dicts, and return (slot, value).
+    PValue among all dicts, and return (slot, value). A VoteStore can stand in
+    for a dict, without making a PValue per slot.
 
     See test_max_sv().
     """
     slot_to_ballot_value: dict[Slot, tuple[Ballot, Value]] = {}
+
+    def update(slot: Slot, ballot: Ballot, value: Value):
+        if (slot not in slot_to_ballot_value
+                or slot_to_ballot_value[slot][0] < ballot):
+            slot_to_ballot_value[slot] = (ballot, value)
+
     for v in vs:
-        for slot, pvalue in v.items():
-            assert pvalue.slot == slot
-            if (slot not in slot_to_ballot_value
-                or slot_to_ballot_value[slot][0] < pvalue.ballot):
-                slot_to_ballot_value[slot] = (pvalue.ballot, pvalue.value)
+        if isinstance(v, VoteStore):
+            for slot, ballot, value in v.max_ballot_values():
+                update(slot, ballot, value)
+        else:
+            for slot, pvalue in v.items():
+                assert pvalue.slot == slot
+                update(slot, pvalue.ballot, pvalue.value)
 
     return {SlotValue(slot, value)
             for slot, (_, value) in slot_to_ballot_value.items()}
@@ -310,15 +771,19 @@ class Acceptor(Agent):
     def __init__(self,
                  config: Config,
                  promise_url: str,
-                 accepted_url: str):
+                 accepted_url: str,
+                 rotating: bool = False):
         super().__init__(config)
         self._promise_url = promise_url
         self._accepted_url = accepted_url
+        # Rotating slot ownership, see Proposer.
+        self._rotating = rotating
         # Highest ballot seen. "aBal" in Chand.
         self._ballot: Ballot = Ballot.min()
         # Highest ballot voted for per slot. "aVoted" in Chand. Grows forever.
-        self._voted: VotedSet = {}
+        self._voted = VoteStore()
 
+    @tracing.traced
     def _handle_prepare(self, prepare: Prepare) -> None:
         # Phase 1b, Fig. 3 in Chand.
         if prepare.ballot <= self._ballot:
@@ -327,31 +792,103 @@ class Acceptor(Agent):
             return
 
         self._ballot = prepare.ballot
-        promise = Promise(self.get_uri(), self._ballot, self._voted)
+        promise = Promise(self.get_uri(),
+                          self._ballot,
+                          self._voted.to_voted_set())
         self._send(prepare.from_uri, self._promise_url, promise)
 
-    def _handle_accept(self, accept: Accept) -> None:
+    @tracing.traced
+    def _handle_accept(self, accept: Accept) -> bool:
+        """Vote for accept's values, return True if accepted."""
+        if self._rotating:
+            return self._handle_own_slots_accept(accept)
+
         # Phase 2b, Fig. 5 in Chand. Note < for accept and <= for prepare.
         if accept.ballot < self._ballot:
             _logger.info("Ignore Phase 2a Accept with stale %s, mine is %s",
                          accept.ballot, self._ballot)
-            return
+            return False
 
         self._ballot = accept.ballot
         # TODO: right?
-        accept_voted_set = {sv.slot: PValue(accept.ballot, sv.slot, sv.value)
-                            for sv in accept.voted}
-        self._voted.update(accept_voted_set)
-        accepted = Accepted(self.get_uri(), self._ballot, accept.voted)
-        self._send_to_all(self._accepted_url, accepted)
+        self._voted.vote(accept.ballot, accept.voted)
+        return True
+
+    def _handle_own_slots_accept(self, accept: Accept) -> bool:
+        # Rotating slot ownership. Each slot has one proposer, who proposes
+        # one value, so there are no ballots to compare. Accept all or none,
+        # so a Learner sees the same Accepted from each Acceptor.
+        for sv in accept.voted:
+            if self._config.slot_owner(sv.slot) != accept.from_uri:
+                _logger.info("Ignore Accept from %s, doesn't own %s",
+                             accept.from_uri, sv)
+                return False
+
+            voted_value = self._voted.get_value(sv.slot)
+            if voted_value is not None and voted_value != sv.value:
+                _logger.info("Ignore Accept from %s, I voted %s for slot %s",
+                             accept.from_uri, voted_value, sv.slot)
+                return False
+
+        self._voted.vote(accept.ballot, accept.voted)
+        return True
 
     def _main_loop(self, q: queue.Queue[Agent._QEntry]) -> None:
         while True:
-            entry = q.get()
-            # Replies are meaningless, we respond by sending new messages.
-            entry.reply_future.set_result(OK())
+            batch = self._get_batch(q)
+            with tracing.profiled():
+                self._handle_batch(batch)
+
+    def _handle_batch(self, batch: list[Agent._QEntry]) -> None:
+        """Handle all queued messages, with one reply per ballot.
+
+        The network could've delivered these messages in any order, so choose
+        the order that accepts the most: Accepts by ascending ballot, then the
+        highest Prepare. Lower Prepares are stale by then, don't reply.
+        """
+        prepares: list[Agent._QEntry] = []
+        accepts: list[Agent._QEntry] = []
+        for entry in batch:
             if isinstance(entry.message, Prepare):
-                self._handle_prepare(entry.message)
+                prepares.append(entry)
+            elif isinstance(entry.message, Accept):
+                try:
+                    VoteStore.check(entry.message.voted)
+                except ValueError as exc:
+                    entry.reply_future.set_exception(exc)
+                    continue
+
+                accepts.append(entry)
             else:
-                assert isinstance(entry.message, Accept)
-                self._handle_accept(entry.message)
+                entry.reply_future.set_exception(
+                    ValueError(f"Unexpected {entry.message}"))
+                continue
+
+            # Replies are meaningless, we respond by sending new messages.
+            entry.reply_future.set_result(OK())
+
+        # Merge Accepts with the same ballot, e.g. resent Accepts. Trace the
+        # merged Accepted as part of the first Accept.
+        accepted_voted: dict[Ballot, dict[Slot, SlotValue]] = defaultdict(dict)
+        accepted_entry: dict[Ballot, Agent._QEntry] = {}
+        for entry in sorted(accepts, key=lambda e: e.message.ballot):
+            accept = entry.message
+            with entry.tracing():
+                if self._handle_accept(accept):
+                    accepted_voted[accept.ballot].update(
+                        (sv.slot, sv) for sv in accept.voted)
+                    accepted_entry.setdefault(accept.ballot, entry)
+
+        for ballot, voted in accepted_voted.items():
+            accepted = Accepted(self.get_uri(), ballot, list(voted.values()))
+            with accepted_entry[ballot].tracing():
+                self._send_to_all(self._accepted_url, accepted)
+
+        if prepares:
+            highest = max(prepares, key=lambda e: e.message.ballot)
+            if len(prepares) > 1:
+                _logger.info("Ignore %s Phase 1a Prepares superseded by %s",
+                             len(prepares) - 1, highest.message.ballot)
+
+            with highest.tracing():
+                self._handle_prepare(highest.message)
@@ -2,7 +2,11 @@ import dataclasses
 import functools
 import types
 import typing
+import weakref
+from array import array
+from collections.abc import Mapping
 from dataclasses import dataclass
+from typing import Optional
 
 __all__ = [
     "Ballot",
@@ -10,14 +14,18 @@ __all__ = [
     "SlotValue",
     "PValue",
     "VotedSet",
+    "VoteStore",
     "Message",
     "Value",
     "ClientRequest",
     "ClientReply",
+    "KVReply",
     "Prepare",
     "Promise",
     "Accept",
     "Accepted",
+    "CatchUpRequest",
+    "CatchUpReply",
     "OK",
 ]
 
@@ -26,7 +34,11 @@ Slot = int
 
 @dataclass(unsafe_hash=True)
 class JSONish:
-    """Base class. Interoperates with JSON-ish dicts."""
+    """Base class. Interoperates with JSON-ish dicts.
+
+    Subclasses declare __slots__ to save memory, so fields can't have defaults.
+    """
+    __slots__ = ()
 
     @classmethod
     def from_dict(cls: typing.Type["JSONish"], dct: dict[str, typing.Any]):
@@ -37,11 +49,12 @@ class JSONish:
         def make_field(typ, val):
             if getattr(typ, '__origin__', None) is typing.Union:
                 # Like "Union[str, int]" or "Optional[thing]".
+                if val is None and type(None) in typ.__args__:
+                    # Before trying other types, since str(None) works.
+                    return None
+
                 errors = []
                 for subtype in typ.__args__:
-                    if issubclass(subtype, type(None)) and val is None:
-                        return None
-
                     try:
                         return subtype(val)
                     except Exception as exc:
@@ -76,25 +89,65 @@ class JSONish:
         })
 
 
-@dataclass(unsafe_hash=True)
+def _cached_hash(self) -> int:
+    """Hash of dataclass fields, computed once. Instances must not change.
+
+    For classes that are dict keys or set members on the hot path. They set
+    "__hash__ = _cached_hash" and have a "_hash" slot.
+    """
+    try:
+        return self._hash
+    except AttributeError:
+        self._hash = hash(
+            tuple(getattr(self, f.name) for f in dataclasses.fields(self)))
+        return self._hash
+
+
+@dataclass(eq=True)
 class Value(JSONish):
+    __slots__ = ("client_id", "command_id", "payload", "_hash")
     client_id: int
     command_id: int
-    payload: int
+    # An int for AppendList, a str for KVStore, see statemachine.py.
+    payload: typing.Union[int, str]
+
+    __hash__ = _cached_hash
+
+    @classmethod
+    def noop(cls):
+        """Fills a slot without changing the RSM."""
+        return Value(-1, -1, 0)
+
+    def is_noop(self) -> bool:
+        return self == Value.noop()
+
+
+# Decoded Ballots, so each distinct Ballot is one object.
+_ballots: "weakref.WeakValueDictionary[Ballot, Ballot]" = (
+    weakref.WeakValueDictionary())
 
 
 @functools.total_ordering
-@dataclass(unsafe_hash=True)
+@dataclass(eq=True)
 class Ballot(JSONish):
+    __slots__ = ("ts", "server_id", "_hash", "__weakref__")
     ts: float
     """Timestamp."""
     server_id: str
     """Server id for uniqueness."""
 
+    __hash__ = _cached_hash
+
     @classmethod
     def min(cls):
         return cls(-1.0, "")
 
+    @classmethod
+    def from_dict(cls, dct: dict[str, typing.Any]):
+        # A Promise has the same Ballot in many slots, share one object.
+        ballot = super().from_dict(dct)
+        return _ballots.setdefault(ballot, ballot)
+
     def __lt__(self, other):
         if not isinstance(other, Ballot):
             return NotImplemented
@@ -102,36 +155,157 @@ class Ballot(JSONish):
         return (self.ts, self.server_id) < (other.ts, other.server_id)
 
 
-@dataclass(unsafe_hash=True)
+@dataclass(eq=True)
 class SlotValue(JSONish):
     """A (slot number, value) pair, called "SV" in Chand."""
+    __slots__ = ("slot", "value", "_hash")
     slot: Slot
     value: Value
 
+    __hash__ = _cached_hash
 
-@dataclass(unsafe_hash=True)
+
+@dataclass(eq=True)
 class PValue(JSONish):
     """As in Chand, a (ballot, slot, value) 3-tuple.
 
     I think the name means "proposal value".
     """
+    __slots__ = ("ballot", "slot", "value", "_hash")
     ballot: Ballot
     slot: Slot
     value: Value
 
+    __hash__ = _cached_hash
+
 
 VotedSet = dict[Slot, PValue]
 """Tracks how Acceptors have voted."""
 
 
+class VoteStore(Mapping):
+    """An Acceptor's VotedSet in parallel arrays, indexed by slot - 1.
+
+    Each slot stores a Value and an index into a list of distinct Ballots, not
+    a PValue. Reading a slot makes a PValue, see to_voted_set().
+    """
+
+    def __init__(self):
+        # Distinct Ballots that some slot votes in, with free ids set to None.
+        # A Ballot's id is reused once no slot votes in it. With rotating slot
+        # ownership each batch of own-slot Accepts has its own Ballot, which
+        # its slots keep, so this grows by 1 per batch, not per slot.
+        self._ballots: list[Optional[Ballot]] = []
+        self._ballot_ids: dict[Ballot, int] = {}
+        # Per ballot id, how many slots vote in it.
+        self._ballot_refs = array("i")
+        self._free_ballot_ids: list[int] = []
+        # Per slot, index into _ballots, or -1 if no vote.
+        self._slot_ballots = array("i")
+        self._values: list[Optional[Value]] = []
+        self._len = 0
+
+    def vote(self, ballot: Ballot, voted: typing.Iterable[SlotValue]) -> None:
+        """Vote for values in a ballot, replacing earlier votes.
+
+        Raises ValueError if a slot is less than 1, see check().
+        """
+        voted = list(voted)
+        self.check(voted)
+        if not voted:
+            return
+
+        ballot_id = self._ballot_ids.get(ballot)
+        if ballot_id is None:
+            ballot_id = self._new_ballot_id(ballot)
+
+        refs = self._ballot_refs
+        for sv in voted:
+            i = sv.slot - 1
+            if i >= len(self._values):
+                n_new = i + 1 - len(self._values)
+                self._slot_ballots.extend([-1] * n_new)
+                self._values.extend([None] * n_new)
+
+            old_id = self._slot_ballots[i]
+            if old_id == -1:
+                self._len += 1
+            elif old_id != ballot_id:
+                refs[old_id] -= 1
+                if refs[old_id] == 0:
+                    self._free_ballot_id(old_id)
+
+            if old_id != ballot_id:
+                refs[ballot_id] += 1
+
+            self._slot_ballots[i] = ballot_id
+            self._values[i] = sv.value
+
+    def _new_ballot_id(self, ballot: Ballot) -> int:
+        if self._free_ballot_ids:
+            ballot_id = self._free_ballot_ids.pop()
+            self._ballots[ballot_id] = ballot
+        else:
+            ballot_id = len(self._ballots)
+            self._ballots.append(ballot)
+            self._ballot_refs.append(0)
+
+        self._ballot_ids[ballot] = ballot_id
+        return ballot_id
+
+    def _free_ballot_id(self, ballot_id: int) -> None:
+        del self._ballot_ids[self._ballots[ballot_id]]
+        self._ballots[ballot_id] = None
+        self._free_ballot_ids.append(ballot_id)
+
+    @staticmethod
+    def check(voted: typing.Iterable[SlotValue]) -> None:
+        """Raise ValueError if a slot is less than 1, before voting."""
+        for sv in voted:
+            if sv.slot < 1:
+                raise ValueError(f"slot must be at least 1, not {sv.slot}")
+
+    def get_value(self, slot: Slot) -> Optional[Value]:
+        """The value voted for in slot, or None."""
+        if 0 < slot <= len(self._values):
+            return self._values[slot - 1]
+
+    def max_ballot_values(
+            self) -> typing.Iterator[tuple[Slot, Ballot, Value]]:
+        """Yield (slot, ballot, value) for each slot voted."""
+        ballots = self._ballots
+        for i, ballot_id in enumerate(self._slot_ballots):
+            if ballot_id != -1:
+                yield i + 1, ballots[ballot_id], self._values[i]
+
+    def to_voted_set(self) -> VotedSet:
+        return {slot: PValue(ballot, slot, value)
+                for slot, ballot, value in self.max_ballot_values()}
+
+    def __getitem__(self, slot: Slot) -> PValue:
+        value = self.get_value(slot)
+        if value is None:
+            raise KeyError(slot)
+
+        return PValue(self._ballots[self._slot_ballots[slot - 1]], slot, value)
+
+    def __iter__(self) -> typing.Iterator[Slot]:
+        return (slot for slot, _, _ in self.max_ballot_values())
+
+    def __len__(self) -> int:
+        return self._len
+
+
 @dataclass(unsafe_hash=True)
 class Message(JSONish):
     """Base class for Paxos protocol requests and replies."""
-    pass
+    __slots__ = ()
 
 
 @dataclass(unsafe_hash=True)
 class ClientRequest(Message, Value):
+    __slots__ = ()
+
     def get_value(self) -> Value:
         # Right now ClientRequest and Value are the same, this method is in
         # case they're ever different.
@@ -140,13 +314,23 @@ class ClientRequest(Message, Value):
 
 @dataclass(unsafe_hash=True)
 class ClientReply(Message):
+    __slots__ = ("state",)
     state: list[int]
     """Replicated state machine's new state."""
 
 
+@dataclass(unsafe_hash=True)
+class KVReply(Message):
+    """Reply to a command for KVStore, see statemachine.py."""
+    __slots__ = ("ok", "value")
+    ok: bool
+    value: Optional[str]
+
+
 @dataclass(unsafe_hash=True)
 class Prepare(Message):
     """Phase 1a message."""
+    __slots__ = ("from_uri", "ballot")
     # "from" in Chand. Unused, could be nice for diagnostics.
     from_uri: str
     # "bal" in Chand.
@@ -156,6 +340,7 @@ class Prepare(Message):
 @dataclass(unsafe_hash=True)
 class Promise(Message):
     """Phase 1b message."""
+    __slots__ = ("from_uri", "ballot", "voted")
     # "from" in Chand. Unused, could be nice for diagnostics.
     from_uri: str
     # "bal" in Chand.
@@ -166,6 +351,7 @@ class Promise(Message):
 @dataclass(unsafe_hash=True)
 class Accept(Message):
     """Command an acceptor to accept! Phase 2a message."""
+    __slots__ = ("from_uri", "ballot", "voted")
     # "from" in Chand. Unused, could be nice for diagnostics.
     from_uri: str
     # "bal" in Chand.
@@ -177,9 +363,27 @@ class Accept(Message):
 @dataclass(unsafe_hash=True)
 class Accepted(Accept):
     """Phase 2b message."""
+    __slots__ = ()
+
+
+@dataclass(unsafe_hash=True)
+class CatchUpRequest(Message):
+    """A lagging Learner asks a peer for decisions it missed."""
+    __slots__ = ("from_uri", "first_slot")
+    from_uri: str
+    # Send decisions for this slot and all later slots.
+    first_slot: Slot
+
+
+@dataclass(unsafe_hash=True)
+class CatchUpReply(Message):
+    """One batch of decided (slot, value) pairs, replying to CatchUpRequest."""
+    __slots__ = ("from_uri", "decided")
+    from_uri: str
+    decided: list[SlotValue]
 
 
 @dataclass(unsafe_hash=True)
 class OK(Message):
     """Acknowledge a message."""
-    pass
+    __slots__ = ()
@@ -1,29 +1,241 @@
 import concurrent.futures
+import json
 import requests
 import logging
-from typing import Optional
+import time
+import zlib
+from typing import Callable, Mapping, Optional
+
+import tracing
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 _logger = logging.getLogger("network")
 
+# Reuse connections to each node, like the router's to its group workers, see
+# server.py --groups. Servers keep connections alive, see server.py. The pool
+# keeps up to 100 idle connections per node, the default --max-client-requests.
+_session = requests.Session()
+_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=100))
+
+
+class MessageTooLarge(ValueError):
+    """A compressed body would decompress to more than the limit."""
+
+
+def _zlib_decompress(body: bytes, max_length: int) -> bytes:
+    """Decompress up to max_length + 1 bytes, enough to tell it's too large."""
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(body, max_length + 1)
+    if not decompressor.eof and len(result) <= max_length:
+        raise ValueError("incomplete or truncated stream")
+
+    return result
+
+
+def _zstd_decompress(body: bytes, max_length: int) -> bytes:
+    """Decompress up to max_length + 1 bytes, enough to tell it's too large.
+
+    Not zstandard.decompress(), which trusts the size in the frame header.
+    """
+    chunks = []
+    n = 0
+    with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+        while n <= max_length:
+            chunk = reader.read(max_length + 1 - n)
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            n += len(chunk)
+
+    return b"".join(chunks)
+
+
+# HTTP content codings for message bodies, best first: name -> (compress,
+# decompress). "deflate" in HTTP means the zlib format.
+ENCODINGS: dict[str, tuple[Callable[[bytes], bytes],
+                           Callable[[bytes, int], bytes]]]
+ENCODINGS = {"deflate": (zlib.compress, _zlib_decompress)}
+if zstandard is not None:
+    ENCODINGS = {"zstd": (zstandard.compress, _zstd_decompress),
+                 **ENCODINGS}
+
+# Codings this process uses, and the smallest body worth compressing.
+_encodings: list[str] = list(ENCODINGS)
+_compress_min_bytes = 1024
+# Largest body to decompress, a small body could decompress to gigabytes.
+_max_message_bytes = 64 * 1024 * 1024
+# Codings each node accepts in request bodies, from its Accept-Encoding
+# response header (RFC 7694). Until a node answers, send it uncompressed.
+_node_encodings: dict[str, list[str]] = {}
+
+
+def configure_compression(encodings: list[str],
+                          min_bytes: int,
+                          max_message_bytes: int = 64 * 1024 * 1024) -> None:
+    """Use these codings, best first, for bodies of min_bytes or more.
+
+    Refuse to decompress bodies larger than max_message_bytes.
+    """
+    global _encodings, _compress_min_bytes, _max_message_bytes
+    for e in encodings:
+        if e not in ENCODINGS:
+            raise ValueError(f"unsupported encoding {e!r}")
+
+    _encodings = list(encodings)
+    _compress_min_bytes = min_bytes
+    _max_message_bytes = max_message_bytes
+
+
+def accept_encoding() -> str:
+    """Value for an Accept-Encoding header."""
+    return ", ".join(_encodings) or "identity"
+
+
+def parse_accept_encoding(header: Optional[str]) -> list[str]:
+    """Codings in an Accept-Encoding header, ignoring those with "q=0"."""
+    result = []
+    for item in (header or "").split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+
+        if name and q > 0:
+            result.append(name.lower())
+
+    return result
+
+
+def compress(body: bytes,
+             accepted: list[str]) -> tuple[Optional[str], bytes]:
+    """Compress with our best coding the receiver accepts, if worthwhile.
+
+    Returns the coding, or None if the body is unchanged, and the body.
+    """
+    if len(body) < _compress_min_bytes:
+        return None, body
+
+    for e in _encodings:
+        if e in accepted:
+            compressed = ENCODINGS[e][0](body)
+            if len(compressed) < len(body):
+                return e, compressed
+
+            break
+
+    return None, body
+
+
+def decompress(encoding: Optional[str], body: bytes) -> bytes:
+    """Undo compress(). Raises ValueError for an unknown or corrupt coding,
+    and MessageTooLarge if the result is bigger than the limit, see
+    configure_compression().
+    """
+    if encoding is None or encoding == "identity":
+        return body
+
+    if encoding not in ENCODINGS:
+        raise ValueError(f"unsupported encoding {encoding!r}")
+
+    try:
+        result = ENCODINGS[encoding][1](body, _max_message_bytes)
+    except Exception as exc:
+        raise ValueError(f"can't decompress {encoding}: {exc}") from exc
+
+    if len(result) > _max_message_bytes:
+        raise MessageTooLarge(
+            f"{encoding} body decompresses to over {_max_message_bytes} bytes")
+
+    return result
+
+
+def post(
+    *,
+    node: str,
+    url: str,
+    raw_message: dict,
+    timeout: float = 5,
+    trace_id: Optional[str] = None
+) -> tuple[int, Mapping[str, str], Optional[dict]]:
+    """Post JSON, return the status, headers, and JSON body or None.
+
+    Like send(), but returns error responses too. Raises RequestException if
+    there's no response.
+    """
+    headers = {"Content-Type": "application/json",
+               "Accept-Encoding": accept_encoding()}
+    if trace_id:
+        headers[tracing.TRACE_HEADER] = trace_id
+
+    # Make sure url starts with "/".
+    full_url = f"http://{node}/{url.lstrip('/')}"
+    with tracing.trace_id(trace_id), tracing.span(f"send {url}"):
+        body = json.dumps(raw_message, separators=(",", ":")).encode()
+        encoding, body = compress(body, _node_encodings.get(node, []))
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+
+        # Stream, to decompress the response ourselves, even zstd.
+        with _session.post(full_url,
+                           data=body,
+                           headers=headers,
+                           timeout=timeout,
+                           stream=True) as response:
+            _node_encodings[node] = parse_accept_encoding(
+                response.headers.get("Accept-Encoding"))
+            content = response.raw.read(decode_content=False)
+
+    try:
+        reply = json.loads(
+            decompress(response.headers.get("Content-Encoding"), content))
+    except ValueError:
+        # E.g., an HTML error page.
+        reply = None
+
+    return response.status_code, response.headers, reply
+
 
 def send(
-    *, node: str, url: str, raw_message: dict, timeout: int = 5
+    *,
+    node: str,
+    url: str,
+    raw_message: dict,
+    timeout: float = 5,
+    trace_id: Optional[str] = None
 ) -> Optional[dict]:
     """Post JSON and return response or None on error.
 
-    Timeout is in seconds.
+    Timeout is in seconds. Trace id is passed on in a header, see tracing.py.
+    Compresses the body if the node accepts it, see configure_compression().
     """
     try:
-        # Make sure url starts with "/".
-        full_url = f"http://{node}/{url.lstrip('/')}"
-        response = requests.post(full_url,
-                                 json=raw_message,
-                                 timeout=timeout)
-        response.raise_for_status()
-        return response.json()
+        status, _, reply = post(node=node,
+                                url=url,
+                                raw_message=raw_message,
+                                timeout=timeout,
+                                trace_id=trace_id)
     except requests.exceptions.RequestException as exc:
         _logger.warning(exc)
-        # If post() or raise_for_status() threw, return None.
+        return None
+
+    if status >= 400:
+        _logger.warning("Status %s from %s%s", status, node, url)
+        return None
+
+    if reply is None:
+        _logger.warning("Reply from %s%s isn't JSON", node, url)
+
+    return reply
 
 
 def send_to_all(
@@ -31,7 +243,8 @@ def send_to_all(
     nodes: list[str],
     url: str,
     raw_message: dict,
-    timeout: int = 10
+    timeout: int = 10,
+    trace_id: Optional[str] = None
 ) -> list[Optional[dict]]:
     """Post JSON concurrently to all servers, and return gathered responses.
 
@@ -43,7 +256,41 @@ def send_to_all(
         return send(node=node,
                     url=url,
                     raw_message=raw_message,
-                    timeout=timeout)
+                    timeout=timeout,
+                    trace_id=trace_id)
 
     with concurrent.futures.ThreadPoolExecutor() as executor:
         return list(executor.map(send_one, nodes))
+
+
+def await_all(
+    *,
+    nodes: list[str],
+    url: str,
+    timeout: float,
+    interval: float = 0.05
+) -> bool:
+    """GET url from all servers concurrently, retrying until each succeeds.
+
+    Nodes is a list of ["host:port", ...]. Timeout and interval are in seconds.
+    Returns False if any server hasn't succeeded before the timeout.
+    """
+    deadline = time.monotonic() + timeout
+
+    def await_one(node):
+        full_url = f"http://{node}/{url.lstrip('/')}"
+        while True:
+            try:
+                response = _session.get(
+                    full_url, timeout=max(deadline - time.monotonic(), 0.01))
+                response.raise_for_status()
+                return True
+            except requests.exceptions.RequestException as exc:
+                if time.monotonic() + interval > deadline:
+                    _logger.warning(exc)
+                    return False
+
+                time.sleep(interval)
+
+    with concurrent.futures.ThreadPoolExecutor(len(nodes)) as executor:
+        return all(list(executor.map(await_one, nodes)))
@@ -0,0 +1,78 @@
+import dataclasses
+import json
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+"""
+Record inbound messages to a file, to replay them later with replay.py.
+
+A recording is JSON lines. The first is a header object, see Header. Each other
+line is one message: [seconds since recording began, agent class name, message
+class name, message as a dict].
+"""
+
+__all__ = [
+    "Header",
+    "Record",
+    "Recorder",
+    "read_recording",
+]
+
+
+@dataclass
+class Header:
+    nodes: list[str]
+    self_node: str
+    rotating: bool
+    # Added later, so older recordings lack it.
+    state_machine: str = "list"
+
+
+@dataclass
+class Record:
+    offset: float
+    """Seconds since recording began."""
+    agent: str
+    message_type: str
+    raw_message: dict
+
+
+class Recorder:
+    """Append messages to a recording. Thread-safe."""
+
+    def __init__(self, path: str, header: Header):
+        self._file = open(path, "w", buffering=1)
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._write(dataclasses.asdict(header))
+
+    def record(self, agent: str, message_type: str, raw_message: dict):
+        with self._lock:
+            self._write([round(time.monotonic() - self._start, 6),
+                         agent,
+                         message_type,
+                         raw_message])
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _write(self, obj):
+        self._file.write(json.dumps(obj, separators=(",", ":")))
+        self._file.write("\n")
+
+
+def read_recording(
+        path: str) -> tuple[Header, typing.Iterator[Record]]:
+    """Read the header, and lazily the records."""
+    file = open(path)
+    header = Header(**json.loads(file.readline()))
+
+    def gen():
+        with file:
+            for line in file:
+                yield Record(*json.loads(line))
+
+    return header, gen()
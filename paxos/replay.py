@@ -0,0 +1,124 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Optional
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import message
+import tracing
+from core import Acceptor, Agent, Config, Proposer
+from message import Message
+from recording import read_recording
+from statemachine import STATE_MACHINES
+
+"""
+Replay a recording from server.py --record into fresh agents, without a network.
+
+Benchmarks core.py and message.py on real traffic. Messages the agents send are
+counted and discarded, so the agents' behavior can diverge from the recording's,
+e.g. a replayed Proposer chooses new ballots, but the recorded replies to its
+messages still drive it.
+"""
+
+
+class _ReplayProposer(Proposer):
+    sent = 0
+
+    def _send(self, node: str, url: str, message: Message) -> None:
+        self.sent += 1
+
+    def _send_to_all(self, url: str, message: Message) -> None:
+        self.sent += len(self._config.nodes)
+
+
+class _ReplayAcceptor(Acceptor):
+    sent = 0
+
+    def _send(self, node: str, url: str, message: Message) -> None:
+        self.sent += 1
+
+    def _send_to_all(self, url: str, message: Message) -> None:
+        self.sent += len(self._config.nodes)
+
+
+def main(path: str,
+         paced: bool,
+         trace_path: Optional[str] = None) -> None:
+    """Replay the recording at path, optionally write spans to trace_path.
+
+    Call tracing.configure() first to record spans.
+    """
+    header, records = read_recording(path)
+    config = Config(header.nodes)
+    config.set_self(header.self_node)
+    agents: dict[str, Agent] = {
+        "Proposer": _ReplayProposer(
+            config=config,
+            propose_url="/acceptor/prepare",
+            accept_url="/acceptor/accept",
+            catch_up_url="/proposer/catch-up",
+            catch_up_reply_url="/proposer/catch-up-reply",
+            rotating=header.rotating,
+            state_machine=STATE_MACHINES[header.state_machine]()),
+        "Acceptor": _ReplayAcceptor(
+            config=config,
+            promise_url="/proposer/promise",
+            accepted_url="/proposer/accepted",
+            rotating=header.rotating),
+    }
+
+    # Message type name -> [count, seconds].
+    stats: dict[str, list] = defaultdict(lambda: [0, 0.0])
+    start = time.monotonic()
+    for r in records:
+        if paced:
+            delay = start + r.offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        t = time.perf_counter()
+        msg = getattr(message, r.message_type).from_dict(r.raw_message)
+        agents[r.agent]._handle_batch([Agent._QEntry(msg, Future())])
+        stats[r.message_type][0] += 1
+        stats[r.message_type][1] += time.perf_counter() - t
+
+    elapsed = time.monotonic() - start
+    total = sum(n for n, _ in stats.values())
+    print(f"{total} messages in {elapsed:.3f} seconds,"
+          f" {total / elapsed if elapsed else 0:.0f} per second")
+    for name, (n, seconds) in sorted(stats.items()):
+        print(f"{name:>16}: {n:>8} messages,"
+              f" {seconds * 1e6 / n:>8.1f} us each")
+
+    print(f"{sum(a.sent for a in agents.values())} messages sent")
+    if trace_path is not None:
+        with open(trace_path, "w") as f:
+            json.dump(tracing.chrome_trace(), f)
+
+        print(f"Wrote tracing spans to {trace_path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Paxos replay")
+    parser.add_argument(
+        "recording", help="File from server.py --record")
+    parser.add_argument(
+        "--paced", action="store_true",
+        help="Replay at the recorded pace. Default: as fast as possible")
+    parser.add_argument(
+        "--trace", default=None, metavar="FILE",
+        help="Write tracing spans to FILE in Chrome trace format, like"
+             " server.py's /admin/trace")
+    parser.add_argument(
+        "--trace-spans", type=int, default=100_000,
+        help="With --trace, keep this many of the latest spans")
+    args = parser.parse_args()
+    tracing.configure(args.trace_spans if args.trace is not None else 0)
+    logging.basicConfig(level=logging.WARNING)
+    main(args.recording, args.paced, args.trace)
@@ -1,21 +1,40 @@
 import argparse
 import dataclasses
+import io
 import logging
+import multiprocessing
 import os.path
 import signal
 import sys
+import threading
 import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 from typing import Optional, Type
 
 import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, abort, jsonify, request
+from werkzeug.exceptions import (BadRequest,
+                                 RequestEntityTooLarge,
+                                 UnsupportedMediaType)
+from werkzeug.serving import WSGIRequestHandler
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
+import tracing
 from core import *
 from message import *
+from network import (ENCODINGS,
+                     MessageTooLarge,
+                     accept_encoding,
+                     await_all,
+                     compress,
+                     configure_compression,
+                     decompress,
+                     parse_accept_encoding,
+                     post)
+from recording import Header, Recorder
+from statemachine import STATE_MACHINES, AppendList, StateMachine
 
 """
 A single Paxos server process with Paxos agents serving various roles:
@@ -24,12 +43,87 @@ A single Paxos server process with Paxos agents serving various roles:
 
 The agents communicate with each other, and with agents in other server
 processes, via HTTP requests. Clients (see client.py) communicate with Replicas.
+
+With --groups N > 1, the state is partitioned among N independent Paxos groups.
+This process only routes client requests by key, each group's agents run in a
+worker process listening on its own port, see group_node().
 """
 
 app = Flask('PyPaxos')
 
+
+class _DecompressRequests:
+    """WSGI middleware, undoes network.send()'s compression of request bodies.
+
+    Flask doesn't decode a request's Content-Encoding.
+    """
+
+    def __init__(self, wsgi_app):
+        self._wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.pop("HTTP_CONTENT_ENCODING", None)
+        if encoding is not None:
+            encoding = encoding.strip().lower()
+            if encoding not in ENCODINGS and encoding != "identity":
+                error = UnsupportedMediaType(f"unsupported encoding {encoding}")
+                return error(environ, start_response)
+
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            try:
+                body = decompress(encoding, environ["wsgi.input"].read(length))
+            except MessageTooLarge as exc:
+                return RequestEntityTooLarge(str(exc))(environ, start_response)
+            except ValueError as exc:
+                return BadRequest(str(exc))(environ, start_response)
+
+            environ["wsgi.input"] = io.BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+
+        return self._wsgi_app(environ, start_response)
+
+
+app.wsgi_app = _DecompressRequests(app.wsgi_app)
+
+
+class _KeepAliveHandler(WSGIRequestHandler):
+    """Keeps connections open for network.py's connection pool.
+
+    Werkzeug's default, HTTP/1.0, makes a TCP connection per message.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def make_environ(self):
+        environ = super().make_environ()
+        if environ.get("wsgi.input_terminated"):
+            # Chunked, let Werkzeug read it, then close.
+            self.close_connection = True
+        else:
+            # Read the whole body, even if we reply without it, e.g. 503. The
+            # rest would be misread as the next request.
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            environ["wsgi.input"] = io.BytesIO(self.rfile.read(length))
+
+        return environ
+
+
 server_id = uuid.uuid4().hex
 
+# Number of Paxos groups, see --groups.
+n_groups = 1
+# To route client requests by the keys in their commands, see --state-machine.
+routing_state_machine: StateMachine = AppendList()
+
+# Set once this server knows its entry in the config, and its groups are up.
+ready = threading.Event()
+
+# Admission control, see --max-client-requests and --client-timeout.
+client_requests_allowed = threading.BoundedSemaphore(100)
+client_timeout = 20.0
+
+# Records inbound messages for replay.py, see --record.
+recorder: Optional[Recorder] = None
+
 
 @app.route('/server_id', methods=['GET'])
 def get_server_id():
@@ -37,10 +131,32 @@ def get_server_id():
     return jsonify(server_id)
 
 
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    """Used to await startup, see start-servers.py."""
+    if not ready.is_set():
+        abort(503)
+
+    return jsonify(True)
+
+
 @app.route('/proposer/client-request', methods=['POST'])
 def client_request():
     """Receive client request, see client.py."""
-    return handle(proposer, ClientRequest)
+    if not client_requests_allowed.acquire(blocking=False):
+        # Overloaded. Fail fast, so the client can retry soon or elsewhere.
+        response = jsonify("too many client requests")
+        response.status_code = 503
+        response.headers["Retry-After"] = "1"
+        return response
+
+    try:
+        if n_groups > 1:
+            return route_client_request()
+
+        return handle(proposer, ClientRequest, timeout=client_timeout)
+    finally:
+        client_requests_allowed.release()
 
 
 @app.route('/acceptor/prepare', methods=['POST'])
@@ -67,13 +183,131 @@ def accepted():
     return handle(proposer, Accepted)
 
 
-def handle(agent: Agent, message_type: Type[Message]):
+@app.route('/proposer/catch-up', methods=['POST'])
+def catch_up():
+    """A lagging Learner asks for decisions it missed."""
+    return handle(proposer, CatchUpRequest)
+
+
+@app.route('/proposer/catch-up-reply', methods=['POST'])
+def catch_up_reply():
+    """Receive a batch of decisions we missed."""
+    return handle(proposer, CatchUpReply)
+
+
+@app.route('/admin/trace', methods=['GET'])
+def get_trace():
+    """Recent spans in Chrome trace event format, see tracing.py."""
+    return jsonify(tracing.chrome_trace())
+
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def profile():
+    """POST {"every": N} to profile one in N batches of messages, 0 to stop.
+
+    GET the profile so far, as text.
+    """
+    if request.method == 'POST':
+        tracing.set_profiling(int(request.json["every"]))
+        return jsonify(True)
+
+    return Response(tracing.profile_report(), mimetype='text/plain')
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    """Compress the body if the client accepts it, see network.compress().
+
+    Also tell clients which codings we accept in request bodies (RFC 7694).
+    """
+    response.headers["Accept-Encoding"] = accept_encoding()
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+
+    encoding, body = compress(
+        response.get_data(),
+        parse_accept_encoding(request.headers.get("Accept-Encoding")))
+    if encoding is not None:
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+
+    return response
+
+
+def handle(agent: Agent,
+           message_type: Type[Message],
+           timeout: Optional[float] = None):
+    trace_id = request.headers.get(tracing.TRACE_HEADER)
+    with tracing.trace_id(trace_id or tracing.new_trace_id()), \
+            tracing.span(f"handle {message_type.__name__}"):
+        try:
+            with tracing.span("from_dict"):
+                try:
+                    message = message_type.from_dict(request.json)
+                except TypeError as exc:
+                    # Missing fields or wrong types.
+                    raise ValueError(str(exc)) from exc
+
+            if recorder is not None:
+                recorder.record(type(agent).__name__,
+                                message_type.__name__,
+                                request.json)
+
+            return jsonify(dataclasses.asdict(
+                agent.receive(message, timeout=timeout)))
+        except TimeoutError:
+            abort(504)
+        except ValueError as exc:
+            # E.g., a malformed message, or a stale or invalid command.
+            logging.info("Bad request %s: %s", request.json, exc)
+            response = jsonify(str(exc))
+            response.status_code = 400
+            return response
+        except Exception:
+            logging.error("Processing input: %s", request.json)
+            raise
+
+
+def route_client_request():
+    """Forward a client request to the group that owns its key."""
+    key = request.args.get("key")
+    try:
+        command_key = routing_state_machine.key(request.json.get("payload"))
+    except ValueError as exc:
+        response = jsonify(str(exc))
+        response.status_code = 400
+        return response
+
+    if command_key is not None:
+        if key is not None and key != command_key:
+            response = jsonify(
+                f"key {key!r} isn't the command's key {command_key!r}")
+            response.status_code = 400
+            return response
+
+        key = command_key
+
+    group = group_for_key(key or "", n_groups)
     try:
-        return jsonify(dataclasses.asdict(
-                agent.receive(message_type.from_dict(request.json))))
-    except Exception:
-        logging.error("Processing input: %s", request.json)
-        raise
+        status, headers, reply = post(
+            node=group_node(config.get_self(), group),
+            url=request.path,
+            raw_message=request.json,
+            # A bit longer than the worker, so its 504 reaches the client.
+            timeout=client_timeout + 1,
+            trace_id=request.headers.get(tracing.TRACE_HEADER))
+    except requests.RequestException as exc:
+        logging.warning("Forwarding to group %s: %s", group, exc)
+        abort(502)
+
+    # Pass on the worker's errors, like 503 and its Retry-After.
+    response = jsonify(reply)
+    response.status_code = status
+    if "Retry-After" in headers:
+        response.headers["Retry-After"] = headers["Retry-After"]
+
+    return response
 
 
 def reverse_url(endpoint: str):
@@ -84,14 +318,164 @@ def reverse_url(endpoint: str):
     return app.url_map.bind("example").build(endpoint)
 
 
+def start_agents(agents_config: Config,
+                 rotating: bool,
+                 state_machine: str) -> None:
+    global proposer, acceptor
+    proposer = Proposer(config=agents_config,
+                        propose_url=reverse_url("prepare"),
+                        accept_url=reverse_url("accept"),
+                        catch_up_url=reverse_url("catch_up"),
+                        catch_up_reply_url=reverse_url("catch_up_reply"),
+                        rotating=rotating,
+                        state_machine=STATE_MACHINES[state_machine]())
+    proposer.run()
+    acceptor = Acceptor(config=agents_config,
+                        promise_url=reverse_url("promise"),
+                        accepted_url=reverse_url("accepted"),
+                        rotating=rotating)
+    acceptor.run()
+
+
+def start_recording(path: str,
+                    agents_config: Config,
+                    rotating: bool,
+                    state_machine: str) -> None:
+    global recorder
+    recorder = Recorder(path, Header(nodes=agents_config.nodes,
+                                     self_node=agents_config.get_self(),
+                                     rotating=rotating,
+                                     state_machine=state_machine))
+
+
+def find_self(nodes: list[str]) -> Optional[str]:
+    """Find the entry in 'nodes' for this process, or None.
+
+    Probes all nodes concurrently, until one replies with our server_id.
+    """
+    deadline = time.monotonic() + 20 * len(nodes)
+    reason: Optional[Exception] = None
+
+    def probe(n: str) -> bool:
+        node_url = f"http://{n}{reverse_url('get_server_id')}"
+        return requests.get(node_url, timeout=1).json() == server_id
+
+    executor = ThreadPoolExecutor(len(nodes))
+    try:
+        while time.monotonic() < deadline:
+            futures = {executor.submit(probe, n): n for n in nodes}
+            for f in as_completed(futures):
+                try:
+                    if f.result():
+                        return futures[f]
+                except requests.RequestException as exc:
+                    reason = exc
+
+            # Our own Flask app might not be listening yet.
+            time.sleep(0.05)
+    finally:
+        # Don't wait for slow probes of other nodes.
+        executor.shutdown(wait=False)
+
+    logging.getLogger("server").error(
+        "Failed to find self in config, reason: %s", reason)
+    return None
+
+
+def run_group(group: int,
+              nodes: list[str],
+              self_node: str,
+              log_file: Optional[str],
+              rotating: bool,
+              state_machine: str,
+              max_client_requests: int,
+              timeout: float,
+              trace_spans: int,
+              record: Optional[str],
+              compression: list[str],
+              compress_min_bytes: int,
+              max_message_bytes: int) -> None:
+    """Worker process entry point: serve one Paxos group."""
+    tracing.configure(trace_spans)
+    configure_compression(compression, compress_min_bytes, max_message_bytes)
+    global config, client_requests_allowed, client_timeout
+    config = Config(nodes)
+    client_requests_allowed = threading.BoundedSemaphore(max_client_requests)
+    client_timeout = timeout
+    config.set_self(self_node)
+    group_config = config.for_group(group)
+    port = int(group_config.get_self().rsplit(":", 1)[1])
+    logging.basicConfig(
+        filename=log_file,
+        format=f"[%(asctime)s] p{port} g{group} %(levelname)s %(message)s",
+        level=logging.INFO)
+    if record is not None:
+        start_recording(
+            f"{record}.{group}", group_config, rotating, state_machine)
+
+    start_agents(group_config, rotating, state_machine)
+    ready.set()
+    app.run(host="0.0.0.0", port=port, request_handler=_KeepAliveHandler)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Paxos node")
     parser.add_argument("--port", type=int, default=5000)
     parser.add_argument("--config", type=argparse.FileType(), required=True,
                         help="Config file (see example-config)")
+    parser.add_argument("--self", dest="self_node", default=None,
+                        help="My entry in the config file, like host:port."
+                             " Default: find self by probing all nodes")
     parser.add_argument("--log-file", default=None)
+    parser.add_argument("--groups", type=int, default=1,
+                        help="Number of Paxos groups, each in its own process")
+    parser.add_argument("--rotating-slots", action="store_true",
+                        help="Assign slots to nodes round-robin, all servers"
+                             " must use the same setting")
+    parser.add_argument("--state-machine", choices=list(STATE_MACHINES),
+                        default="list",
+                        help="The replicated state machine, see"
+                             " statemachine.py. All servers must use the same")
+    parser.add_argument("--max-client-requests", type=int, default=100,
+                        help="Reply 503 to client requests beyond this many"
+                             " in progress")
+    parser.add_argument("--client-timeout", type=float, default=20,
+                        help="Seconds until a client gives up, see client.py")
+    parser.add_argument("--trace-spans", type=int, default=100_000,
+                        help="Keep this many recent tracing spans, see"
+                             " /admin/trace. 0 disables tracing")
+    parser.add_argument("--record", default=None, metavar="FILE",
+                        help="Record inbound messages to FILE, see replay.py."
+                             " With --groups, each group records to FILE.N."
+                             " Without, recording starts after finding self"
+                             " in the config, and misses earlier messages")
+    parser.add_argument("--compression", default=",".join(ENCODINGS),
+                        help="Content codings for large messages, best first,"
+                             f" from {list(ENCODINGS)}, or 'none'."
+                             " Default: %(default)s")
+    parser.add_argument("--compress-min-bytes", type=int, default=1024,
+                        help="Compress messages at least this large")
+    parser.add_argument("--max-message-bytes", type=int,
+                        default=64 * 1024 * 1024,
+                        help="Reply 413 to compressed messages that would"
+                             " decompress to more than this")
 
     args = parser.parse_args()
+    compression = ([] if args.compression == "none"
+                   else args.compression.split(","))
+    try:
+        configure_compression(compression,
+                              args.compress_min_bytes,
+                              args.max_message_bytes)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    n_groups = args.groups
+    routing_state_machine = STATE_MACHINES[args.state_machine]()
+    client_requests_allowed = threading.BoundedSemaphore(
+        args.max_client_requests)
+    client_timeout = args.client_timeout
+    tracing.configure(args.trace_spans)
 
     # Uses stdout/stderr if log_file is None.
     logging.basicConfig(
@@ -100,41 +484,87 @@ if __name__ == "__main__":
         level=logging.INFO)
     logger = logging.getLogger("server")
 
+    start = time.monotonic()
     config = Config.from_file(args.config, default_port=args.port)
     assert config.nodes
-    proposer = Proposer(config=config,
-                        propose_url=reverse_url("prepare"),
-                        accept_url=reverse_url("accept"))
-    proposer.run()
-    acceptor = Acceptor(config=config,
-                        promise_url=reverse_url("promise"),
-                        accepted_url=reverse_url("accepted"))
-    acceptor.run()
+    self_node: Optional[str] = args.self_node
+    if self_node is not None:
+        if ":" not in self_node:
+            self_node = f"{self_node}:{args.port}"
+
+        if self_node not in config.nodes:
+            parser.error(f"--self {self_node} not in config {config.nodes}")
+
+        config.set_self(self_node)
+
+    if n_groups == 1:
+        start_agents(config, args.rotating_slots, args.state_machine)
+
     # Run Flask app in background so we can do "finding self" logic below.
     executor = ThreadPoolExecutor()
-    app_done = executor.submit(lambda: app.run(host="0.0.0.0", port=args.port))
+    app_done = executor.submit(lambda: app.run(
+        host="0.0.0.0", port=args.port, request_handler=_KeepAliveHandler))
 
-    logger.info("Finding self in config of %s nodes", len(config.nodes))
-    start = time.monotonic()
-    found_self = False
-    reason: Optional[Exception] = None
-    while time.monotonic() - start < 20 * len(config.nodes) and not found_self:
-        for n in config.nodes:
-            node_url = f"http://{n}{reverse_url('get_server_id')}"
-            try:
-                if requests.get(node_url, timeout=10).json() == server_id:
-                    config.set_self(n)
-                    found_self = True
-                    logger.info("Found self: %s", n)
-                    break
-            except requests.RequestException as exc:
-                reason = exc
-                time.sleep(1)
-                continue
-
-    if not found_self:
-        logger.error("Failed to find self in config, reason: %s", reason)
-        # Simpler than the self-pipe trick, if brutal.
+    if self_node is None:
+        logger.info("Finding self in config of %s nodes", len(config.nodes))
+        self_node = find_self(config.nodes)
+        if self_node is None:
+            # Simpler than the self-pipe trick, if brutal.
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        logger.info("Found self: %s", self_node)
+        config.set_self(self_node)
+
+    workers = []
+
+    def on_sigterm(signum, frame):
+        for w in workers:
+            w.terminate()
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
         os.kill(os.getpid(), signal.SIGTERM)
 
+    signal.signal(signal.SIGTERM, on_sigterm)
+    if n_groups > 1:
+        # Don't fork a process with threads, spawn fresh interpreters.
+        mp_context = multiprocessing.get_context("spawn")
+        for g in range(n_groups):
+            worker = mp_context.Process(
+                target=run_group,
+                args=(g,
+                      config.nodes,
+                      self_node,
+                      args.log_file,
+                      args.rotating_slots,
+                      args.state_machine,
+                      args.max_client_requests,
+                      args.client_timeout,
+                      args.trace_spans,
+                      args.record,
+                      compression,
+                      args.compress_min_bytes,
+                      args.max_message_bytes),
+                daemon=True)
+            worker.start()
+            workers.append(worker)
+            logger.info("Started group %s on %s, pid %s",
+                        g, group_node(self_node, g), worker.pid)
+
+        groups_ready = await_all(
+            nodes=[group_node(self_node, g) for g in range(n_groups)],
+            url=reverse_url("get_ready"),
+            timeout=60)
+    else:
+        groups_ready = True
+
+    if n_groups == 1 and args.record is not None:
+        start_recording(
+            args.record, config, args.rotating_slots, args.state_machine)
+
+    if groups_ready:
+        ready.set()
+        logger.info("Ready in %.3f seconds", time.monotonic() - start)
+    else:
+        logger.error("Groups not ready after 60 seconds")
+
     app_done.result()
@@ -2,14 +2,22 @@ import argparse
 import os.path
 import subprocess
 import sys
+import time
 import typing
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from core import Config
+from network import await_all
 
 
-def main(raw_config: typing.IO, config_path: str, port: int):
+def main(raw_config: typing.IO,
+         config_path: str,
+         port: int,
+         groups: int,
+         rotating_slots: bool,
+         state_machine: str):
+    start = time.monotonic()
     config = Config.from_file(raw_config, default_port=port)
     nodes = []
     for s in config.nodes:
@@ -20,8 +28,20 @@ def main(raw_config: typing.IO, config_path: str, port: int):
             '--port',
             port,
             '--config',
-            config_path
-        ]))
+            config_path,
+            # Save each server the trouble of finding itself.
+            '--self',
+            s,
+            '--groups',
+            str(groups),
+            '--state-machine',
+            state_machine
+        ] + (['--rotating-slots'] if rotating_slots else [])))
+
+    if await_all(nodes=config.nodes, url='/ready', timeout=60):
+        print(f"Cluster ready in {time.monotonic() - start:.3f} seconds")
+    else:
+        print("Cluster not ready after 60 seconds", file=sys.stderr)
 
     for n in nodes:
         n.wait()
@@ -33,5 +53,16 @@ if __name__ == '__main__':
                         help="Config file (see example-config)")
     parser.add_argument("--port", type=int, default=5000,
                         help="Default port (if not in config)")
+    parser.add_argument("--groups", type=int, default=1,
+                        help="Paxos groups per server (see server.py)")
+    parser.add_argument("--rotating-slots", action="store_true",
+                        help="Assign slots to servers round-robin")
+    parser.add_argument("--state-machine", default="list",
+                        help="The replicated state machine (see server.py)")
     args = parser.parse_args()
-    main(args.config, args.config.name, args.port)
+    main(args.config,
+         args.config.name,
+         args.port,
+         args.groups,
+         args.rotating_slots,
+         args.state_machine)
@@ -0,0 +1,159 @@
+import typing
+from typing import Optional
+
+from message import ClientReply, KVReply, Message, Value
+
+"""
+Replicated state machines (RSMs) for the Proposer / Learner to apply decisions
+to. Every server applies the same commands in the same order, so they must be
+deterministic.
+"""
+
+__all__ = [
+    "StateMachine",
+    "AppendList",
+    "KVStore",
+    "STATE_MACHINES",
+]
+
+Result = typing.Any
+
+
+class StateMachine:
+    """Base class."""
+
+    def check(self, payload: typing.Union[int, str]) -> None:
+        """Raise ValueError if payload isn't a command, before proposing it."""
+        raise NotImplementedError()
+
+    def key(self, payload: typing.Union[int, str]) -> Optional[str]:
+        """The key that chooses the command's Paxos group, see server.py
+        --groups. None if the client chooses, with client.py --key.
+        """
+        raise NotImplementedError()
+
+    def apply_batch(self, values: list[Value]) -> list[Result]:
+        """Execute a run of commands in log order, return their results.
+
+        The Proposer stores each client's latest result to answer retries, so
+        keep results small, see reply().
+        """
+        raise NotImplementedError()
+
+    def reply(self, result: Result) -> Message:
+        """The reply to the client for a result from apply_batch()."""
+        raise NotImplementedError()
+
+    def snapshot(self) -> typing.Any:
+        """The state as a JSON-ish object, see restore().
+
+        Only the RSM's state. Proposer.snapshot() adds the client sessions,
+        without them a restored server could apply a retried command twice.
+        """
+        raise NotImplementedError()
+
+    def restore(self, snapshot: typing.Any) -> None:
+        """Replace the state with a snapshot()."""
+        raise NotImplementedError()
+
+
+class AppendList(StateMachine):
+    """An appendable list of ints. The payload is an int to append."""
+
+    def __init__(self):
+        self.state: list[int] = []
+
+    def check(self, payload: typing.Union[int, str]) -> None:
+        if not isinstance(payload, int):
+            raise ValueError(f"payload must be an int, not {payload!r}")
+
+    def key(self, payload: typing.Union[int, str]) -> Optional[str]:
+        return None
+
+    def apply_batch(self, values: list[Value]) -> list[Result]:
+        start = len(self.state)
+        self.state.extend(v.payload for v in values)
+        # The reply is the list so far, remember its length, not a copy.
+        return list(range(start + 1, len(self.state) + 1))
+
+    def reply(self, result: int) -> Message:
+        return ClientReply(self.state[:result])
+
+    def snapshot(self) -> list[int]:
+        return self.state.copy()
+
+    def restore(self, snapshot: list[int]) -> None:
+        self.state = snapshot.copy()
+
+
+class KVStore(StateMachine):
+    """A dict of strings. The payload is a command like:
+
+    "get KEY": reply ok if KEY exists, with its value.
+    "put KEY VALUE": reply ok.
+    "cas KEY OLD NEW": set KEY to NEW if its value is OLD. Reply ok if so, with
+                       the value before.
+    """
+
+    _n_args = {"get": 1, "put": 2, "cas": 3}
+
+    def __init__(self):
+        self.state: dict[str, str] = {}
+
+    @classmethod
+    def _parse(cls, payload: typing.Union[int, str]) -> list[str]:
+        if not isinstance(payload, str):
+            raise ValueError(f"payload must be a str, not {payload!r}")
+
+        op, *args = payload.split(" ")
+        if len(args) != cls._n_args.get(op, -1):
+            raise ValueError(f"bad command {payload!r}")
+
+        return [op, *args]
+
+    def check(self, payload: typing.Union[int, str]) -> None:
+        self._parse(payload)
+
+    def key(self, payload: typing.Union[int, str]) -> Optional[str]:
+        # A command's key must be in the group with the rest of its history.
+        return self._parse(payload)[1]
+
+    def apply_batch(self, values: list[Value]) -> list[Result]:
+        state = self.state
+        results: list[tuple[bool, Optional[str]]] = []
+        for v in values:
+            try:
+                op, key, *args = self._parse(v.payload)
+            except ValueError:
+                # Proposed by a server with another state machine?
+                results.append((False, None))
+                continue
+
+            current = state.get(key)
+            if op == "get":
+                results.append((key in state, current))
+            elif op == "put":
+                state[key] = args[0]
+                results.append((True, None))
+            elif current == args[0]:  # "cas".
+                state[key] = args[1]
+                results.append((True, current))
+            else:
+                results.append((False, current))
+
+        return results
+
+    def reply(self, result: tuple[bool, Optional[str]]) -> Message:
+        return KVReply(*result)
+
+    def snapshot(self) -> dict[str, str]:
+        return self.state.copy()
+
+    def restore(self, snapshot: dict[str, str]) -> None:
+        self.state = snapshot.copy()
+
+
+STATE_MACHINES: dict[str, typing.Type[StateMachine]] = {
+    "list": AppendList,
+    "kv": KVStore,
+}
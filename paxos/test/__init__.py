@@ -1,11 +1,27 @@
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from concurrent.futures import Future, TimeoutError
 from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from typing import Optional
 
 from flask.json import dumps, loads
+from werkzeug.serving import make_server
 
+import network
+import replay
+import server
+import tracing
 from message import *
-from core import max_sv
+from core import Acceptor, Agent, Config, Proposer, group_for_key, group_node, max_sv
+from recording import Header, Recorder, read_recording
+from statemachine import AppendList, KVStore
 
 
 @dataclass
@@ -86,6 +102,9 @@ class MessageTest(unittest.TestCase):
 
     def test_optional_absent(self):
         self.assertEqual(E.from_dict({}), E(None))
+        # Not "None", though str(None) works.
+        self.assertEqual(KVReply.from_dict({"ok": False, "value": None}),
+                         KVReply(False, None))
 
     def test_optional_type_error(self):
         with self.assertRaises(TypeError):
@@ -93,6 +112,54 @@ class MessageTest(unittest.TestCase):
             E.from_dict({"x": "string"})
 
 
+class VoteStoreTest(unittest.TestCase):
+    def test_vote(self):
+        store = VoteStore()
+        store.vote(Ballot(1, "a"), [SlotValue(1, Value(1, 1, 1)),
+                                    SlotValue(3, Value(1, 3, 3))])
+        store.vote(Ballot(2, "a"), [SlotValue(3, Value(1, 3, 4))])
+        self.assertEqual(len(store), 2)
+        self.assertNotIn(2, store)
+        self.assertIsNone(store.get_value(2))
+        self.assertIsNone(store.get_value(4))
+        self.assertEqual(store.to_voted_set(), {
+            1: PValue(Ballot(1, "a"), 1, Value(1, 1, 1)),
+            3: PValue(Ballot(2, "a"), 3, Value(1, 3, 4)),
+        })
+
+    def test_ballots_freed(self):
+        store = VoteStore()
+        b1, b2, b3 = Ballot(1, "a"), Ballot(2, "a"), Ballot(3, "a")
+        store.vote(b1, [SlotValue(1, Value(1, 1, 1)),
+                        SlotValue(2, Value(1, 2, 2))])
+        store.vote(b2, [SlotValue(1, Value(1, 1, 1))])
+        store.vote(b2, [SlotValue(2, Value(1, 2, 2))])
+        self.assertEqual(store._ballot_ids, {b2: 1})
+        # Reuses b1's id.
+        store.vote(b3, [SlotValue(3, Value(1, 3, 3))])
+        self.assertEqual(store._ballot_ids, {b2: 1, b3: 0})
+        self.assertEqual(store.to_voted_set(), {
+            1: PValue(b2, 1, Value(1, 1, 1)),
+            2: PValue(b2, 2, Value(1, 2, 2)),
+            3: PValue(b3, 3, Value(1, 3, 3)),
+        })
+
+    def test_bad_slot(self):
+        store = VoteStore()
+        for slot in [0, -1]:
+            with self.subTest(slot=slot):
+                self.assertRaises(ValueError, store.vote, Ballot(1, "a"),
+                                  [SlotValue(slot, Value(1, 1, 1))])
+                self.assertEqual(len(store), 0)
+
+    def test_ballots_interned(self):
+        promise = Promise.from_dict(asdict(Promise("host:1", Ballot(2, "a"), {
+            1: PValue(Ballot(1, "a"), 1, Value(4, 5, 6)),
+            2: PValue(Ballot(1, "a"), 2, Value(4, 5, 7)),
+        })))
+        self.assertIs(promise.voted[1].ballot, promise.voted[2].ballot)
+
+
 class MaxSVTest(unittest.TestCase):
     """Test the MaxSV operator from Fig. 4 of Chand."""
 
@@ -116,3 +183,751 @@ class MaxSVTest(unittest.TestCase):
                 # Preempted by ballot 4  above.
                 2: PValue(Ballot(3, ""), 2, Value(1, 2, 11))
             }]))
+
+    def test_max_sv_vote_store(self):
+        store = VoteStore()
+        store.vote(Ballot(4, ""), [SlotValue(2, Value(1, 2, 5))])
+        store.vote(Ballot(1, ""), [SlotValue(1, Value(1, 2, 2))])
+        self.assertEqual(
+            {
+                SlotValue(1, Value(1, 2, 3)),
+                SlotValue(2, Value(1, 2, 5)),
+            },
+            max_sv([store, {
+                1: PValue(Ballot(2, ""), 1, Value(1, 2, 3)),
+                2: PValue(Ballot(3, ""), 2, Value(1, 2, 11)),
+            }]))
+
+
+class _TestProposer(Proposer):
+    """Records outgoing messages instead of sending them."""
+
+    def __init__(self, nodes: list[str], **kwargs):
+        config = Config(nodes)
+        config.set_self(nodes[0])
+        super().__init__(config,
+                         propose_url="/prepare",
+                         accept_url="/accept",
+                         catch_up_url="/catch-up",
+                         catch_up_reply_url="/catch-up-reply",
+                         **kwargs)
+        self.sent: list[tuple[str, str, Message]] = []
+
+    def _send(self, node: str, url: str, message: Message) -> None:
+        self.sent.append((node, url, message))
+
+    def _send_to_all(self, url: str, message: Message) -> None:
+        self.sent.append(("all", url, message))
+
+
+class CatchUpTest(unittest.TestCase):
+    @staticmethod
+    def _accepted(server_id: str, slot_payloads: list[tuple[int, int]]):
+        ballot = Ballot(1, "a:1")
+        return Accepted(server_id, ballot, [
+            SlotValue(slot, Value(1, slot, payload))
+            for slot, payload in slot_payloads])
+
+    def _reply(self, proposer: Proposer, message: Message) -> None:
+        future = Future()
+        proposer._handle_batch([Agent._QEntry(message, future)])
+        self.assertEqual(future.result(), OK())
+
+    def test_gap_blocks_apply_and_requests_catch_up(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        # A majority accepted slot 2, we missed slot 1.
+        for node in ["a:1", "b:1"]:
+            self._reply(p, self._accepted(node, [(2, 20)]))
+
+        self.assertEqual(p._state_machine.state, [])
+        self.assertEqual(len(p.sent), 1)
+        node, url, request = p.sent[0]
+        self.assertIn(node, ["b:1", "c:1"])
+        self.assertEqual(url, "/catch-up")
+        self.assertEqual(request, CatchUpRequest("a:1", 1))
+
+        self._reply(p, CatchUpReply("b:1", [SlotValue(1, Value(1, 1, 10)),
+                                            SlotValue(2, Value(1, 2, 20))]))
+        self.assertEqual(p._state_machine.state, [10, 20])
+        self.assertFalse(p._has_gap())
+
+    def test_catch_up_request_batches(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"], catch_up_batch_size=2)
+        for node in ["b:1", "c:1"]:
+            self._reply(p, self._accepted(
+                node, [(1, 10), (2, 20), (3, 30), (4, 40), (5, 50)]))
+
+        self.assertEqual(p._state_machine.state, [10, 20, 30, 40, 50])
+        self._reply(p, CatchUpRequest("b:1", 2))
+        self.assertEqual(
+            [(n, u, [sv.slot for sv in m.decided]) for n, u, m in p.sent],
+            [("b:1", "/catch-up-reply", [2, 3]),
+             ("b:1", "/catch-up-reply", [4, 5])])
+
+
+class GroupTest(unittest.TestCase):
+    def test_group_node(self):
+        self.assertEqual(group_node("host:5000", 0), "host:5100")
+        self.assertEqual(group_node("host:5000", 2), "host:5300")
+
+    def test_group_for_key(self):
+        groups = {group_for_key(str(k), 4) for k in range(100)}
+        self.assertEqual(groups, {0, 1, 2, 3})
+        self.assertEqual(group_for_key("a", 4), group_for_key("a", 4))
+
+    def test_for_group(self):
+        config = Config(["a:1", "b:1"])
+        group_config = config.for_group(1)
+        self.assertEqual(group_config.nodes, ["a:201", "b:201"])
+        config.set_self("b:1")
+        self.assertEqual(group_config.get_self(), "b:201")
+
+
+class _Overloaded(BaseHTTPRequestHandler):
+    """A group worker that's always overloaded."""
+
+    def do_POST(self):
+        self.send_response(503)
+        self.send_header("Retry-After", "7")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RouteTest(unittest.TestCase):
+    def setUp(self):
+        self.worker = HTTPServer(("localhost", 0), _Overloaded)
+        threading.Thread(target=self.worker.serve_forever, daemon=True).start()
+        # Pretend our port is such that the key's group is the worker.
+        port = self.worker.server_port - 100 * (group_for_key("k", 2) + 1)
+        server.config = Config([f"localhost:{port}"])
+        server.config.set_self(f"localhost:{port}")
+        server.n_groups = 2
+
+    def tearDown(self):
+        server.n_groups = 1
+        server.routing_state_machine = AppendList()
+        self.worker.shutdown()
+        self.worker.server_close()
+
+    def test_pass_on_worker_error(self):
+        response = server.app.test_client().post(
+            "/proposer/client-request?key=k",
+            json=asdict(ClientRequest(1, 1, 10)))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "7")
+
+    def test_route_by_command_key(self):
+        server.routing_state_machine = KVStore()
+        client = server.app.test_client()
+        # Reaches the worker for "k" without ?key=.
+        response = client.post("/proposer/client-request",
+                               json=asdict(ClientRequest(1, 1, "put k 1")))
+        self.assertEqual(response.status_code, 503)
+
+        response = client.post("/proposer/client-request?key=other",
+                               json=asdict(ClientRequest(1, 1, "put k 1")))
+        self.assertEqual(response.status_code, 400)
+        response = client.post("/proposer/client-request",
+                               json=asdict(ClientRequest(1, 1, "put k")))
+        self.assertEqual(response.status_code, 400)
+
+
+class _OtherServer(BaseHTTPRequestHandler):
+    """Another server in the config, with its own server_id."""
+
+    def do_GET(self):
+        body = dumps("other").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.app_server = make_server("localhost", 0, server.app)
+        self.other = HTTPServer(("localhost", 0), _OtherServer)
+        for s in [self.app_server, self.other]:
+            threading.Thread(target=s.serve_forever, args=(0.05,),
+                             daemon=True).start()
+
+        self.node = f"localhost:{self.app_server.server_port}"
+        self.other_node = f"localhost:{self.other.server_port}"
+
+    def tearDown(self):
+        server.ready.clear()
+        for s in [self.app_server, self.other]:
+            s.shutdown()
+            s.server_close()
+
+    def test_find_self(self):
+        self.assertEqual(server.find_self([self.other_node, self.node]),
+                         self.node)
+
+    def test_ready(self):
+        client = server.app.test_client()
+        self.assertEqual(client.get("/ready").status_code, 503)
+        server.ready.set()
+        response = client.get("/ready")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads(response.data), True)
+
+    def test_await_all(self):
+        server.ready.set()
+        self.assertTrue(network.await_all(
+            nodes=[self.node, self.other_node], url="/ready", timeout=5))
+
+    def test_await_all_timeout(self):
+        # Not ready, replies 503.
+        start = time.monotonic()
+        self.assertFalse(network.await_all(
+            nodes=[self.node, self.other_node], url="/ready", timeout=0.2))
+        self.assertLess(time.monotonic() - start, 5)
+
+
+class RotatingSlotsTest(unittest.TestCase):
+    def test_slot_owner(self):
+        config = Config(["a:1", "b:1", "c:1"])
+        self.assertEqual([config.slot_owner(s) for s in range(1, 6)],
+                         ["a:1", "b:1", "c:1", "a:1", "b:1"])
+
+    def test_propose_and_skip(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"], rotating=True)
+        p._handle_batch([Agent._QEntry(ClientRequest(1, 1, 10), Future())])
+        _, url, accept = p.sent.pop()
+        self.assertEqual(url, "/accept")
+        self.assertEqual(accept.voted, [SlotValue(1, Value(1, 1, 10))])
+
+        # b:1 used slot 5, so I skip my slot 4.
+        p._handle_batch([Agent._QEntry(
+            Accepted("b:1", Ballot(1, "b:1"), [SlotValue(5, Value(2, 1, 50))]),
+            Future())])
+        _, _, accept = p.sent.pop()
+        self.assertEqual(accept.voted, [SlotValue(4, Value.noop())])
+
+        p._handle_batch([Agent._QEntry(ClientRequest(1, 2, 70), Future()),
+                         Agent._QEntry(ClientRequest(1, 3, 100), Future())])
+        _, _, accept = p.sent.pop()
+        self.assertEqual(accept.voted, [SlotValue(7, Value(1, 2, 70)),
+                                        SlotValue(10, Value(1, 3, 100))])
+
+    def test_resend_under_load(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"],
+                          rotating=True,
+                          accept_resend_interval=60)
+        p._handle_batch([Agent._QEntry(ClientRequest(1, 1, 10), Future())])
+        _, _, accept = p.sent.pop()
+        # Busy with other messages, too soon to resend.
+        p._handle_batch([Agent._QEntry(CatchUpRequest("b:1", 1), Future())])
+        self.assertEqual(p.sent, [])
+
+        p._accept_resend_interval = 0
+        p._handle_batch([Agent._QEntry(CatchUpRequest("b:1", 1), Future())])
+        self.assertEqual(p.sent, [("all", "/accept", accept)])
+
+    def test_duplicate_accepted_not_majority(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"], rotating=True)
+        p._handle_batch([Agent._QEntry(ClientRequest(1, 1, 10), Future())])
+        _, _, accept = p.sent.pop()
+        # One Acceptor answers the Accept, and its resend.
+        accepted = Accepted("a:1", accept.ballot, accept.voted)
+        for _ in range(2):
+            p._handle_batch([Agent._QEntry(accepted, Future())])
+
+        self.assertEqual(p._decisions, {})
+        self.assertEqual(p._state_machine.state, [])
+        p._handle_batch([Agent._QEntry(
+            Accepted("b:1", accept.ballot, accept.voted), Future())])
+        self.assertEqual(p._state_machine.state, [10])
+
+
+class _TestAcceptor(Acceptor):
+    """Records outgoing messages instead of sending them."""
+
+    def __init__(self, nodes: list[str]):
+        config = Config(nodes)
+        config.set_self(nodes[0])
+        super().__init__(config,
+                         promise_url="/promise",
+                         accepted_url="/accepted")
+        self.sent: list[tuple[str, str, Message]] = []
+
+    def _send(self, node: str, url: str, message: Message) -> None:
+        self.sent.append((node, url, message))
+
+    def _send_to_all(self, url: str, message: Message) -> None:
+        self.sent.append(("all", url, message))
+
+
+class BatchTest(unittest.TestCase):
+    def test_one_prepare_per_batch(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        p._handle_batch([Agent._QEntry(ClientRequest(1, i, i), Future())
+                         for i in range(5)])
+        self.assertEqual([url for _, url, _ in p.sent], ["/prepare"])
+
+    def test_acceptor_batch(self):
+        a = _TestAcceptor(["a:1", "b:1", "c:1"])
+        b1, b2, b3 = Ballot(1, "b:1"), Ballot(2, "c:1"), Ballot(3, "b:1")
+        sv = SlotValue(1, Value(1, 1, 1))
+        futures = [Future() for _ in range(5)]
+        a._handle_batch([
+            Agent._QEntry(Prepare("c:1", b2), futures[0]),
+            Agent._QEntry(Accept("b:1", b1, [sv]), futures[1]),
+            # Resent.
+            Agent._QEntry(Accept("b:1", b1, [sv]), futures[2]),
+            Agent._QEntry(Prepare("b:1", b3), futures[3]),
+            Agent._QEntry(Prepare("c:1", b2), futures[4]),
+        ])
+        self.assertTrue(all(f.result() == OK() for f in futures))
+        self.assertEqual(a.sent, [
+            # One Accepted for both Accepts.
+            ("all", "/accepted", Accepted("a:1", b1, [sv])),
+            # Only the highest Prepare gets a Promise.
+            ("b:1", "/promise", Promise("a:1", b3, {1: PValue(b1, 1, sv.value)})),
+        ])
+
+    def test_acceptor_bad_slot(self):
+        a = _TestAcceptor(["a:1", "b:1", "c:1"])
+        sv = SlotValue(1, Value(1, 1, 1))
+        futures = [Future(), Future()]
+        a._handle_batch([
+            Agent._QEntry(Accept("b:1", Ballot(1, "b:1"),
+                                 [sv, SlotValue(0, Value(1, 2, 2))]),
+                          futures[0]),
+            Agent._QEntry(Accept("c:1", Ballot(2, "c:1"), [sv]), futures[1]),
+        ])
+        # server.handle() replies 400.
+        self.assertRaises(ValueError, futures[0].result)
+        self.assertEqual(futures[1].result(), OK())
+        self.assertEqual(a.sent, [
+            ("all", "/accepted", Accepted("a:1", Ballot(2, "c:1"), [sv]))])
+
+
+class SessionTest(unittest.TestCase):
+    @staticmethod
+    def _decide(p: Proposer, svs: list[SlotValue]) -> None:
+        for node in ["b:1", "c:1"]:
+            p._handle_batch([Agent._QEntry(
+                Accepted(node, Ballot(1, "b:1"), svs), Future())])
+
+    def test_duplicate_applied_once(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        future = Future()
+        p._handle_batch([Agent._QEntry(ClientRequest(7, 1, 10), future)])
+        # The client also retried on another server, both were decided.
+        self._decide(p, [SlotValue(1, Value(7, 1, 10)),
+                         SlotValue(2, Value(7, 1, 10)),
+                         SlotValue(3, Value(8, 1, 30))])
+        self.assertEqual(p._state_machine.state, [10, 30])
+        self.assertEqual(future.result(), ClientReply([10]))
+
+        # Another retry is answered from the session, not proposed.
+        p.sent.clear()
+        future = Future()
+        p._handle_batch([Agent._QEntry(ClientRequest(7, 1, 10), future)])
+        self.assertEqual(future.result(), ClientReply([10]))
+        self.assertEqual(p.sent, [])
+
+    def test_retry_in_flight(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        futures = [Future(), Future()]
+        p._handle_batch([Agent._QEntry(ClientRequest(7, 1, 10), futures[0])])
+        p._handle_batch([Agent._QEntry(ClientRequest(7, 1, 10), futures[1])])
+        self.assertEqual([url for _, url, _ in p.sent], ["/prepare"])
+        self._decide(p, [SlotValue(1, Value(7, 1, 10))])
+        self.assertEqual([f.result() for f in futures], [ClientReply([10])] * 2)
+
+    def test_expiry(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"], session_expiry_slots=2)
+        self._decide(p, [SlotValue(1, Value(7, 1, 10)),
+                         SlotValue(2, Value(8, 1, 20))])
+        self.assertEqual(list(p._sessions), [7, 8])
+        self._decide(p, [SlotValue(3, Value(8, 2, 30))])
+        self.assertEqual(list(p._sessions), [8])
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_restore_keeps_sessions(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        SessionTest._decide(p, [SlotValue(1, Value(7, 1, 10)),
+                                SlotValue(2, Value(8, 1, 20))])
+        snapshot = loads(dumps(p.snapshot()))
+
+        restored = _TestProposer(["a:1", "b:1", "c:1"])
+        restored.restore(snapshot)
+        self.assertEqual(restored._state_machine.state, [10, 20])
+        # Client 7 retried, another server proposed it again in slot 3.
+        SessionTest._decide(restored, [SlotValue(3, Value(7, 1, 10)),
+                                       SlotValue(4, Value(9, 1, 40))])
+        self.assertEqual(restored._state_machine.state, [10, 20, 40])
+        self.assertFalse(restored._has_gap())
+
+        future = Future()
+        restored._handle_batch([Agent._QEntry(ClientRequest(8, 1, 20), future)])
+        self.assertEqual(future.result(), ClientReply([10, 20]))
+
+    def test_gap_after_restore(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        p.restore({"applied_through": 5, "state": [1, 2], "sessions": []})
+        SessionTest._decide(p, [SlotValue(7, Value(9, 1, 70))])
+        self.assertTrue(p._has_gap())
+        self.assertEqual(p.sent[-1][2], CatchUpRequest("a:1", 6))
+
+
+class _CountingKVStore(KVStore):
+    def __init__(self):
+        super().__init__()
+        self.batches: list[int] = []
+
+    def apply_batch(self, values: list[Value]) -> list:
+        self.batches.append(len(values))
+        return super().apply_batch(values)
+
+
+class StateMachineTest(unittest.TestCase):
+    def test_append_list(self):
+        sm = AppendList()
+        results = sm.apply_batch([Value(7, 1, 10), Value(8, 1, 20)])
+        self.assertEqual([sm.reply(r) for r in results],
+                         [ClientReply([10]), ClientReply([10, 20])])
+        self.assertRaises(ValueError, sm.check, "put x 1")
+
+        snapshot = sm.snapshot()
+        sm.apply_batch([Value(7, 2, 30)])
+        sm.restore(snapshot)
+        self.assertEqual(sm.state, [10, 20])
+
+    def test_kv_store(self):
+        sm = KVStore()
+        commands = ["get x", "put x 1", "cas x 2 3", "cas x 1 3", "get x",
+                    "bogus"]
+        results = sm.apply_batch(
+            [Value(7, i, c) for i, c in enumerate(commands)])
+        self.assertEqual([sm.reply(r) for r in results], [
+            KVReply(False, None),
+            KVReply(True, None),
+            KVReply(False, "1"),
+            KVReply(True, "1"),
+            KVReply(True, "3"),
+            KVReply(False, None),
+        ])
+        self.assertRaises(ValueError, sm.check, "put x")
+        self.assertRaises(ValueError, sm.check, 1)
+        self.assertEqual(sm.snapshot(), {"x": "3"})
+
+    def test_apply_run_in_one_batch(self):
+        sm = _CountingKVStore()
+        p = _TestProposer(["a:1", "b:1", "c:1"], state_machine=sm)
+        future = Future()
+        p._handle_batch([Agent._QEntry(ClientRequest(7, 2, "get x"), future)])
+        SessionTest._decide(p, [SlotValue(1, Value(8, 1, "put x 1")),
+                                SlotValue(2, Value.noop()),
+                                SlotValue(3, Value(7, 2, "get x"))])
+        self.assertEqual(sm.batches, [2])
+        self.assertEqual(future.result(), KVReply(True, "1"))
+
+        future = Future()
+        p._handle_batch([Agent._QEntry(ClientRequest(9, 1, 42), future)])
+        self.assertRaises(ValueError, future.result)
+
+
+class _InvalidCommandAgent:
+    def receive(self, message: Message, timeout: Optional[float] = None):
+        raise ValueError("bad command 'put x'")
+
+
+class BadRequestTest(unittest.TestCase):
+    def test_value_error_is_400(self):
+        server.proposer = _InvalidCommandAgent()
+        response = server.app.test_client().post(
+            "/proposer/client-request",
+            json=asdict(ClientRequest(1, 1, "put x")))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(loads(response.data), "bad command 'put x'")
+
+        response = server.app.test_client().post(
+            "/proposer/client-request", json={"client_id": 1})
+        self.assertEqual(response.status_code, 400)
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = server.client_requests_allowed
+        server.client_requests_allowed = threading.BoundedSemaphore(1)
+
+    def tearDown(self):
+        server.client_requests_allowed = self.saved
+
+    def test_overloaded_is_503(self):
+        server.proposer = _InvalidCommandAgent()
+        client = server.app.test_client()
+        server.client_requests_allowed.acquire()
+        response = client.post("/proposer/client-request",
+                               json=asdict(ClientRequest(1, 1, 10)))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+        # Admitted once a request finishes, and released after.
+        server.client_requests_allowed.release()
+        for _ in range(2):
+            response = client.post("/proposer/client-request",
+                                   json=asdict(ClientRequest(1, 1, 10)))
+            self.assertEqual(response.status_code, 400)
+
+
+class KeepAliveTest(unittest.TestCase):
+    def setUp(self):
+        # Threaded like app.run(), each kept-alive connection has a thread.
+        self.app_server = make_server("localhost", 0, server.app,
+                                      threaded=True,
+                                      request_handler=server._KeepAliveHandler)
+        threading.Thread(target=self.app_server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.node = f"localhost:{self.app_server.server_port}"
+        self.saved = server.client_requests_allowed
+        server.client_requests_allowed = threading.BoundedSemaphore(1)
+
+    def tearDown(self):
+        server.client_requests_allowed = self.saved
+        self.app_server.shutdown()
+        self.app_server.server_close()
+
+    def test_reuse_connection(self):
+        server.proposer = _InvalidCommandAgent()
+        raw_message = asdict(ClientRequest(1, 1, 10))
+        # Replies 503 without reading the body.
+        server.client_requests_allowed.acquire()
+        status, _, _ = network.post(node=self.node,
+                                    url="/proposer/client-request",
+                                    raw_message=raw_message)
+        self.assertEqual(status, 503)
+        server.client_requests_allowed.release()
+        # The unread body isn't mistaken for a request.
+        status, _, reply = network.post(node=self.node,
+                                        url="/proposer/client-request",
+                                        raw_message=raw_message)
+        self.assertEqual(status, 400)
+        self.assertEqual(reply, "bad command 'put x'")
+        pool = network._session.get_adapter("http://").poolmanager
+        self.assertEqual(
+            pool.connection_from_url(f"http://{self.node}").num_connections, 1)
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_expired_in_queue(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        future = Future()
+        p._handle_batch([Agent._QEntry(
+            ClientRequest(7, 1, 10), future, time.monotonic() - 1)])
+        self.assertRaises(TimeoutError, future.result)
+        self.assertEqual(p.sent, [])
+
+    def test_expired_before_proposal(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        futures = [Future(), Future()]
+        p._handle_batch([
+            Agent._QEntry(ClientRequest(7, 1, 10), futures[0],
+                          time.monotonic() + 0.01),
+            Agent._QEntry(ClientRequest(8, 1, 20), futures[1])])
+        time.sleep(0.02)
+        p._drop_expired_requests()
+        self.assertRaises(TimeoutError, futures[0].result)
+        self.assertEqual(list(p._requests_unserviced),
+                         [ClientRequest(8, 1, 20)])
+
+    def test_retry_extends_deadline(self):
+        p = _TestProposer(["a:1", "b:1", "c:1"])
+        futures = [Future(), Future()]
+        p._handle_batch([
+            Agent._QEntry(ClientRequest(7, 1, 10), futures[0],
+                          time.monotonic() + 0.01),
+            Agent._QEntry(ClientRequest(7, 1, 10), futures[1],
+                          time.monotonic() + 20)])
+        time.sleep(0.02)
+        p._drop_expired_requests()
+        self.assertEqual(list(p._requests_unserviced),
+                         [ClientRequest(7, 1, 10)])
+        self.assertFalse(futures[1].done())
+
+
+class _TraceIdProposer(_TestProposer):
+    """Records the trace id of each outgoing message."""
+
+    def __init__(self, nodes: list[str], **kwargs):
+        super().__init__(nodes, **kwargs)
+        self.trace_ids: list[Optional[str]] = []
+
+    def _send_to_all(self, url: str, message: Message) -> None:
+        super()._send_to_all(url, message)
+        self.trace_ids.append(tracing.get_trace_id())
+
+
+class TracingTest(unittest.TestCase):
+    def test_trace_id_sent_with_proposal(self):
+        for rotating in (False, True):
+            with self.subTest(rotating=rotating):
+                p = _TraceIdProposer(["a:1", "b:1", "c:1"], rotating=rotating)
+                p._handle_batch([
+                    Agent._QEntry(ClientRequest(7, 1, 10), Future(),
+                                  trace_id="T1"),
+                    Agent._QEntry(ClientRequest(8, 1, 20), Future(),
+                                  trace_id="T2")])
+                self.assertEqual(
+                    [u for _, u, _ in p.sent],
+                    ["/accept" if rotating else "/prepare"])
+                self.assertEqual(p.trace_ids, ["T1"])
+
+    def tearDown(self):
+        tracing.configure(100_000)
+        tracing.set_profiling(0)
+
+    def test_chrome_trace(self):
+        tracing.configure(2)
+        with tracing.trace_id("abc"):
+            with tracing.span("outer"):
+                with tracing.span("inner"):
+                    pass
+
+        with tracing.span("last"):
+            pass
+
+        events = tracing.chrome_trace()["traceEvents"]
+        # Ring buffer keeps the latest 2.
+        self.assertEqual([e["name"] for e in events], ["outer", "last"])
+        self.assertEqual(events[0]["args"], {"trace_id": "abc"})
+        self.assertEqual(events[1]["args"], {})
+        self.assertEqual(events[0]["ph"], "X")
+        self.assertGreaterEqual(events[0]["dur"], 0)
+
+    def test_disabled(self):
+        tracing.configure(0)
+        with tracing.span("span"):
+            pass
+
+        self.assertEqual(tracing.chrome_trace()["traceEvents"], [])
+
+    def test_profiling(self):
+        tracing.set_profiling(2)
+        for _ in range(4):
+            with tracing.profiled():
+                max_sv([])
+
+        self.assertIn("max_sv", tracing.profile_report())
+
+
+class RecordingTest(unittest.TestCase):
+    def test_record_and_replay(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        header = Header(nodes=["a", "b", "c"], self_node="a", rotating=False)
+        recorder = Recorder(path, header)
+        prepare = Prepare("b", Ballot(1, "b"))
+        accept = Accept("b", Ballot(1, "b"), [SlotValue(1, Value(7, 1, 10))])
+        recorder.record("Acceptor", "Prepare", asdict(prepare))
+        recorder.record("Acceptor", "Accept", asdict(accept))
+        recorder.close()
+
+        read_header, records = read_recording(path)
+        records = list(records)
+        self.assertEqual(read_header, header)
+        self.assertEqual([(r.agent, r.message_type) for r in records],
+                         [("Acceptor", "Prepare"), ("Acceptor", "Accept")])
+        self.assertEqual(Accept.from_dict(records[1].raw_message), accept)
+        self.assertLessEqual(records[0].offset, records[1].offset)
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            replay.main(path, paced=False)
+
+        # A Promise to "b", an Accepted to all.
+        self.assertIn("2 messages in", out.getvalue())
+        self.assertIn("4 messages sent", out.getvalue())
+
+        tracing.configure(1000)
+        self.addCleanup(tracing.configure, 100_000)
+        trace_path = f"{path}.trace"
+        self.addCleanup(os.remove, trace_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            replay.main(path, paced=False, trace_path=trace_path)
+
+        with open(trace_path) as f:
+            names = {e["name"] for e in loads(f.read())["traceEvents"]}
+
+        self.assertIn("Acceptor._handle_accept", names)
+
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        network.configure_compression(["deflate"], 100)
+
+    def tearDown(self):
+        network.configure_compression(list(network.ENCODINGS), 1024)
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual(
+            network.parse_accept_encoding("zstd;q=0, Deflate;q=0.5, gzip"),
+            ["deflate", "gzip"])
+        self.assertEqual(network.parse_accept_encoding(None), [])
+
+    def test_compress(self):
+        body = b"x" * 1000
+        self.assertEqual(network.compress(body, ["gzip"]), (None, body))
+        self.assertEqual(network.compress(b"x" * 99, ["deflate"]),
+                         (None, b"x" * 99))
+        encoding, compressed = network.compress(body, ["zstd", "deflate"])
+        self.assertEqual(encoding, "deflate")
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(network.decompress(encoding, compressed), body)
+        self.assertRaises(ValueError, network.decompress, "deflate", body)
+        self.assertRaises(ValueError, network.decompress, "br", body)
+        self.assertRaises(ValueError, network.decompress, "deflate",
+                          compressed[:-5])
+        network.configure_compression(["deflate"], 100, 999)
+        self.assertRaises(network.MessageTooLarge,
+                          network.decompress, "deflate", compressed)
+
+    def test_server(self):
+        client = server.app.test_client()
+        body = dumps({"every": 0, "padding": "x" * 200}).encode()
+        encoding, compressed = network.compress(body, ["deflate"])
+        response = client.post("/admin/profile",
+                               data=compressed,
+                               content_type="application/json",
+                               headers={"Content-Encoding": encoding})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Accept-Encoding"], "deflate")
+
+        response = client.post("/admin/profile",
+                               data=body,
+                               content_type="application/json",
+                               headers={"Content-Encoding": "br"})
+        self.assertEqual(response.status_code, 415)
+
+        # A small body that decompresses to more than the limit.
+        network.configure_compression(["deflate"], 100, 1000)
+        response = client.post("/admin/profile",
+                               data=zlib.compress(b" " * 1001),
+                               content_type="application/json",
+                               headers={"Content-Encoding": "deflate"})
+        self.assertEqual(response.status_code, 413)
+        network.configure_compression(["deflate"], 100)
+
+        tracing.configure(100)
+        for _ in range(10):
+            with tracing.span("span"):
+                pass
+
+        response = client.get("/admin/trace",
+                              headers={"Accept-Encoding": "deflate"})
+        self.assertEqual(response.headers["Content-Encoding"], "deflate")
+        self.assertIn("traceEvents",
+                      loads(network.decompress("deflate", response.data)))
+        tracing.configure(100_000)
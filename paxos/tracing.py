@@ -0,0 +1,179 @@
+import contextlib
+import contextvars
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Optional
+
+"""
+Lightweight tracing spans in a ring buffer, exported as Chrome trace events.
+
+Load the JSON from a server's /admin/trace in chrome://tracing or
+https://ui.perfetto.dev. A trace id follows each message from server to server,
+in the X-Trace-Id header, see network.send().
+"""
+
+__all__ = [
+    "TRACE_HEADER",
+    "configure",
+    "new_trace_id",
+    "get_trace_id",
+    "trace_id",
+    "span",
+    "record",
+    "traced",
+    "chrome_trace",
+    "set_profiling",
+    "profiled",
+    "profile_report",
+]
+
+TRACE_HEADER = "X-Trace-Id"
+
+# (name, start, end, thread id, trace id). Start and end from perf_counter().
+_spans: deque[tuple[str, float, float, int, Optional[str]]] = deque(
+    maxlen=100_000)
+# Add to perf_counter() for seconds since the epoch, to line up servers' traces.
+_epoch_offset = time.time() - time.perf_counter()
+_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "trace_id", default=None)
+
+
+def configure(max_spans: int) -> None:
+    """Keep the latest max_spans spans. Zero disables tracing."""
+    global _spans
+    _spans = deque(maxlen=max_spans)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def get_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+@contextlib.contextmanager
+def trace_id(tid: Optional[str]):
+    """Attribute spans in this block to trace id tid."""
+    token = _trace_id.set(tid)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """Record a span for this block."""
+    if not _spans.maxlen:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter())
+
+
+def record(name: str, start: float, end: float) -> None:
+    """Record a span that's already ended, times from perf_counter()."""
+    if _spans.maxlen:
+        _spans.append(
+            (name, start, end, threading.get_ident(), _trace_id.get()))
+
+
+def traced(fn: Callable) -> Callable:
+    """Decorator, record a span for each call."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(fn.__qualname__):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def chrome_trace() -> dict:
+    """Spans in Chrome's trace event format."""
+    pid = os.getpid()
+    return {
+        "displayTimeUnit": "ms",
+        "traceEvents": [{
+            "name": name,
+            "ph": "X",
+            "ts": (start + _epoch_offset) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": pid,
+            "tid": tid,
+            "args": {"trace_id": trace} if trace else {},
+        } for name, start, end, tid, trace in list(_spans)],
+    }
+
+
+_profile_lock = threading.Lock()
+_profile_every = 0
+_profile_count = 0
+_profile_stats: Optional[pstats.Stats] = None
+
+
+def set_profiling(every: int) -> None:
+    """Profile one in 'every' profiled() blocks, or none if 0.
+
+    Discards stats from earlier profiling.
+    """
+    global _profile_every, _profile_count, _profile_stats
+    with _profile_lock:
+        _profile_every = every
+        _profile_count = 0
+        _profile_stats = None
+
+
+@contextlib.contextmanager
+def profiled():
+    """Maybe profile this block with cProfile, see set_profiling()."""
+    global _profile_count, _profile_stats
+    with _profile_lock:
+        _profile_count += 1
+        sample = _profile_every and _profile_count % _profile_every == 0
+
+    if not sample:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another thread is profiling, in Python 3.12+ only one can.
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with _profile_lock:
+            if _profile_stats is None:
+                _profile_stats = pstats.Stats(profiler)
+            else:
+                _profile_stats.add(profiler)
+
+
+def profile_report(limit: int = 50) -> str:
+    """Top functions by cumulative time, from profiled() blocks."""
+    with _profile_lock:
+        if _profile_stats is None:
+            return "No profile, see set_profiling()\n"
+
+        out = io.StringIO()
+        _profile_stats.stream = out
+        _profile_stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# Optional argument: this node's entry in the nodes file, saves finding itself.
+SELF_ARG=${1:+--self $1}
+
 start-stop-daemon --start --background --chdir /home/admin/python-paxos-jepsen/ --chuid admin \
   --make-pidfile --pidfile /var/paxos.pid --startas /bin/bash -- -c \
-  "exec /usr/local/bin/python3.9 paxos/server.py --config /home/admin/nodes > /home/admin/paxos.log 2>&1"
+  "exec /usr/local/bin/python3.9 paxos/server.py --config /home/admin/nodes $SELF_ARG > /home/admin/paxos.log 2>&1"